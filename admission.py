@@ -0,0 +1,124 @@
+import collections
+import json
+import re
+import time
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+import metrics
+
+# (methods or None for any, path pattern, route class), the first match wins, anything else is admin
+ROUTES = [
+    (('POST', 'PUT', 'DELETE'), re.compile(r'/orders/'), 'customer-write'),
+    (None, re.compile(r'/orders/'), 'customer-read'),
+    (('GET', 'HEAD'), re.compile(r'/meals/$'), 'customer-read'),
+    (None, re.compile(r'/(delivery|kitchen|bill)/'), 'kitchen'),
+]
+REASONS = ('full', 'timeout')
+BUSY = json.dumps({"msg": "系統忙碌中，請稍後再試"}).encode('ascii')
+
+class Admission(object):
+    ''' Gives the slots (pool threads) of wsgipool.WSGIHandler to requests by route class, on the IOLoop.
+        A class has up to limits[name] requests in flight, running or waiting for a slot: more are rejected
+        at once, and so is a request still waiting after timeout seconds, with a 503 and Retry-After.
+        A freed slot goes to the classes in priority order, and the last reserved slots only to the first,
+        so the kitchen never waits behind customers. '''
+
+    def __init__(self, slots, limits, priority, reserved=1, timeout=3, retry_after=2, prefix=''):
+        self._slots = slots
+        self._limits = limits
+        self._priority = priority
+        self._reserved = max(0, min(reserved, slots - 1))
+        self._timeout = timeout
+        self._retry_after = retry_after
+        self._prefix = re.compile(r'^%s/[^/]+(?=/)' % re.escape(prefix)) if prefix else None
+        self._running = 0
+        self._waiting = dict((name, collections.deque()) for name in priority) # name -> [future, since, timeout]
+        # every key is there from the start, render() reads them from another thread
+        self.inflight = dict((name, 0) for name in priority)
+        self.admitted = dict((name, 0) for name in priority)
+        self.rejected = dict(((name, reason), 0) for name in priority for reason in REASONS)
+        self.wait = dict((name, metrics.Histogram(metrics.SECONDS)) for name in priority)
+
+    def routeClass(self, method, path):
+        if self._prefix:
+            path = self._prefix.sub('', path, 1)
+        for methods, pattern, name in ROUTES:
+            if (methods is None or method in methods) and pattern.match(path):
+                return name
+        return 'admin'
+
+    #### Slots ####
+    def admit(self, name):
+        ''' a Future of True once the request has a slot, to give back with release(), or of False if it is rejected '''
+        future = Future()
+        if self.inflight[name] >= self._limits.get(name, self._slots):
+            self.rejected[(name, 'full')] += 1
+            future.set_result(False)
+            return future
+        self.inflight[name] += 1
+        waiter = [future, time.monotonic(), None]
+        ahead = self._priority[:self._priority.index(name) + 1] # classes before this one, and this one
+        if self._free(name) and not any(self._waiting[other] for other in ahead):
+            self._start(name, waiter)
+        else:
+            waiter[2] = IOLoop.current().call_later(self._timeout, self._expire, name, waiter)
+            self._waiting[name].append(waiter)
+        return future
+
+    def release(self, name):
+        self._running -= 1
+        self.inflight[name] -= 1
+        for other in self._priority:
+            waiting = self._waiting[other]
+            while waiting and self._free(other):
+                waiter = waiting.popleft()
+                IOLoop.current().remove_timeout(waiter[2])
+                self._start(other, waiter)
+
+    def reject(self, handler):
+        ''' the 503 of a request admit() turned away '''
+        handler.set_status(503)
+        handler.set_header('Retry-After', str(self._retry_after))
+        handler.set_header('Content-Type', 'application/json')
+        handler.finish(BUSY)
+
+    def _free(self, name):
+        return self._running < self._slots - (0 if name == self._priority[0] else self._reserved)
+
+    def _start(self, name, waiter):
+        self._running += 1
+        self.admitted[name] += 1
+        self.wait[name].observe(time.monotonic() - waiter[1])
+        waiter[0].set_result(True)
+
+    def _expire(self, name, waiter):
+        self._waiting[name].remove(waiter)
+        self.inflight[name] -= 1
+        self.rejected[(name, 'timeout')] += 1
+        waiter[0].set_result(False)
+
+    #### Prometheus text format ####
+    def render(self):
+        out = []
+        def series(name, kind, help, values):
+            out.append('# HELP %s %s' % (name, help))
+            out.append('# TYPE %s %s' % (name, kind))
+            for key, value in values:
+                out.append('%s%s %d' % (name, metrics.labels(**key), value))
+        series('pay_admission_inflight', 'gauge', 'Requests running or waiting for a thread, by route class.',
+               [(dict(route=name), self.inflight[name]) for name in self._priority])
+        series('pay_admission_waiting', 'gauge', 'Requests waiting for a thread, by route class.',
+               [(dict(route=name), len(self._waiting[name])) for name in self._priority])
+        series('pay_admission_admitted_total', 'counter', 'Requests given a thread, by route class.',
+               [(dict(route=name), self.admitted[name]) for name in self._priority])
+        series('pay_admission_rejected_total', 'counter', 'Requests answered 503, by route class and reason.',
+              [(dict(route=name, reason=reason), self.rejected[(name, reason)])
+               for name in self._priority for reason in REASONS])
+        out.extend(metrics.histogramLines('pay_admission_wait_seconds', 'Time waiting for a thread.',
+                                          [(dict(route=name), self.wait[name]) for name in self._priority]))
+        return out
+
+def fromConfig(config, slots):
+    ''' the Admission of slots threads set up by the ADMISSION_ settings of a Flask config '''
+    return Admission(slots, config['ADMISSION_LIMITS'], config['ADMISSION_PRIORITY'], config['ADMISSION_RESERVED'],
+                     config['ADMISSION_TIMEOUT'], config['ADMISSION_RETRY_AFTER'], config.get('STORE_PREFIX', ''))
@@ -0,0 +1,99 @@
+''' The static pipeline, python assets.py builds static/build/
+
+Each bundle is concatenated, named after the hash of its content and written with a .gz
+(and a .br when the brotli module is installed) next to it, so main.py can serve them
+precompressed and cached for good. Until a build exists, urls() gives the source files.
+'''
+import base64
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+try:
+    import brotli
+except ImportError: # optional, only .gz files are built without it
+    brotli = None
+
+STATIC = 'static'
+BUILD = 'build' # under STATIC
+MOBILE = 'jquery.mobile-1.4.5/'
+JQUERY = 'vendor/jquery-2.1.3.min.js' # the version jQuery Mobile 1.4.5 supports, kept in the repo for offline shops
+
+# bundle name -> sources under static/, in order
+BUNDLES = {
+    'app.js': [JQUERY, MOBILE + 'jquery.mobile-1.4.5.min.js'],
+    'app.css': [MOBILE + 'jquery.mobile-1.4.5.min.css'],
+}
+
+SOURCE_MAP = re.compile(r'^//[#@] sourceMappingURL=.*$', re.M)
+CSS_URL = re.compile(r'url\((?!data:)["\']?([^"\')]+)["\']?\)')
+
+def inlineUrls(css, base):
+    ''' the images the stylesheet refers to as data URIs, so it needs no other request. The icons are
+        already inline SVG in it, this takes in the PNG fallback of browsers without SVG and the loader '''
+    def dataUri(match):
+        path = os.path.join(base, match.group(1))
+        if not os.path.isfile(path):
+            return match.group(0)
+        with open(path, 'rb') as f:
+            data = base64.b64encode(f.read()).decode('ascii')
+        return 'url(data:%s;base64,%s)' % (mimetypes.guess_type(path)[0], data)
+    return CSS_URL.sub(dataUri, css)
+
+def bundle(name):
+    ''' content of the sources of bundle name '''
+    parts = []
+    for source in BUNDLES[name]:
+        path = os.path.join(STATIC, source)
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        if name.endswith('.css'):
+            text = inlineUrls(text, os.path.dirname(path))
+        parts.append(SOURCE_MAP.sub('', text).rstrip() + '\n')
+    return ''.join(parts).encode('utf-8')
+
+def build():
+    out = os.path.join(STATIC, BUILD)
+    os.makedirs(out, exist_ok=True)
+    manifest, files = {}, set()
+    for name in sorted(BUNDLES):
+        data = bundle(name)
+        stem, ext = os.path.splitext(name)
+        filename = '%s.%s%s' % (stem, hashlib.sha1(data).hexdigest()[:12], ext)
+        manifest[name] = [BUILD + '/' + filename]
+        files.update(filename + suffix for suffix in ('', '.gz', '.br'))
+        path = os.path.join(out, filename)
+        with open(path, 'wb') as f:
+            f.write(data)
+        with open(path + '.gz', 'wb') as f: # mtime 0, the same content builds the same file
+            with gzip.GzipFile(filename, 'wb', 9, f, mtime=0) as z:
+                z.write(data)
+        if brotli:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data))
+        print('%-8s %s %d bytes, gzip %d' % (name, filename, len(data), os.path.getsize(path + '.gz')))
+    for filename in set(os.listdir(out)) - files - {'manifest.json'}: # older builds
+        os.remove(os.path.join(out, filename))
+    with open(os.path.join(out, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+_manifest = None
+
+def urls(name, prefix='/static/'):
+    ''' urls to load bundle name from: the built file, or its sources '''
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(os.path.join(STATIC, BUILD, 'manifest.json')) as f:
+                _manifest = json.load(f)
+        except (IOError, ValueError):
+            _manifest = {}
+    if name in _manifest:
+        return [prefix + url for url in _manifest[name]]
+    return [prefix + source for source in BUNDLES[name]]
+
+if __name__ == '__main__':
+    build()
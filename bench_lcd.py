@@ -0,0 +1,83 @@
+''' I2C transactions and wall time of the display paths, on lcdsim.SimulatedBus
+
+    python bench_lcd.py [-n 200] [--json out.json]
+
+Wall time is the Python side only, the delays Lcd sleeps are counted but not slept.
+Exits 1 if the simulated display does not show what was printed.
+'''
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+import lcd
+import lcdsim
+
+COL, ROW = 16, 2
+
+def measure(bus, op, n):
+    ''' run op n times, the per call averages of the bus counters and wall time '''
+    bus.reset()
+    start = time.perf_counter()
+    for i in range(n):
+        op(i)
+    wall = time.perf_counter() - start
+    return {
+        'calls': n,
+        'transactions': bus.transactions / n,
+        'bytes': bus.bytes / n,
+        'pulses': bus.pulses / n,
+        'sleeps': bus.sleeps / n,
+        'slept_ms': bus.slept * 1000 / n,
+        'required_us': bus.required_us / n,
+        'wall_us': wall * 1000000 / n,
+    }
+
+def check(name, bus, expected):
+    shown = bus.lines(COL, ROW)
+    expected = [expected[r * COL:(r + 1) * COL].ljust(COL) for r in range(ROW)]
+    if shown != expected:
+        print('%s: display shows %r, expected %r' % (name, shown, expected), file=sys.stderr)
+        return False
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=200, help='calls per case')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    results, ok = {}, True
+
+    bus = lcdsim.SimulatedBus()
+    results['begin'] = measure(bus, lambda i: lcd.Lcd(1, 0x27, COL, ROW, bus), max(1, args.n // 10))
+    ok &= check('begin', bus, '')
+
+    screen = lcd.Lcd(1, 0x27, COL, ROW, bus)
+    messages = ['Table %-3d ordered %2d meals' % (i % 40, i % 7 + 1) for i in range(args.n)]
+    results['print message'] = measure(bus, lambda i: screen.print(messages[i]), args.n)
+    ok &= check('print message', bus, messages[-1])
+    results['print same'] = measure(bus, lambda i: screen.print(messages[-1]), args.n)
+    ok &= check('print same', bus, messages[-1])
+
+    # the clock, one tick a second on a display that already shows the time
+    display = lcd.LoopDisplay(1, 0x26, COL, ROW, lcdsim.SimulatedBus())
+    clock = display.lcd
+    display.exit()
+    display.join()
+    bus = clock.bus
+    start = datetime(2016, 1, 1, 12, 0, 0)
+    display.tick(clock, start - timedelta(seconds=1))
+    results['LoopDisplay tick'] = measure(bus, lambda i: display.tick(clock, start + timedelta(seconds=i)), args.n)
+    ok &= check('LoopDisplay tick', bus, display._presentMsg)
+
+    print('%-18s %8s %8s %8s %8s %10s %12s %10s' % ('case', 'i2c tx', 'bytes', 'pulses', 'sleeps', 'slept ms', 'required us', 'wall us'))
+    for name, r in results.items():
+        print('%-18s %8.1f %8.1f %8.1f %8.1f %10.3f %12.1f %10.1f' % (name, r['transactions'], r['bytes'],
+              r['pulses'], r['sleeps'], r['slept_ms'], r['required_us'], r['wall_us']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+''' Restaurant load on pay.app: tables scan their code, load the menu, order and poll,
+    kitchen screens advance the orders and check the tables out.
+
+    python bench_load.py [--mode=client|tornado] [--tables=20] [--kitchens=2] [--rounds=5]
+                         [--polls=3] [--threads=8] [--admission] [--json out.json] [--compare old.json]
+
+client runs requests through the Flask test client in this process, tornado through
+wsgipool.WSGIHandler on a local port, behind the admission control of main.py with
+--admission (its 503s count as errors). Runs on a fresh database in a temporary directory.
+SQL statements are counted on the thread running the request, so with SQLITE_SINGLE_WRITER
+the writes done on the writer thread are not in them.
+'''
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+XHR = {'X-Requested-With': 'XMLHttpRequest'}
+
+#### SQL statements per request ####
+counter = threading.local()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def countStatement(conn, cursor, statement, parameters, context, executemany):
+    counter.statements = getattr(counter, 'statements', 0) + 1
+
+def routeOf(method, path):
+    name = path.strip('/').split('/')[0].lower() or 'index'
+    return '%s %s' % (method, name)
+
+class StatementCounter(object):
+    ''' WSGI middleware adding up the statements each route runs '''
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.statements = {} # route -> [requests, statements]
+
+    def __call__(self, environ, start_response):
+        counter.statements = 0
+        try:
+            return self.app(environ, start_response)
+        finally:
+            with self.lock:
+                total = self.statements.setdefault(routeOf(environ['REQUEST_METHOD'], environ['PATH_INFO']), [0, 0])
+                total[0] += 1
+                total[1] += counter.statements
+
+#### Clients ####
+class TestClient(object):
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, body=None, headers={}, form=None):
+        if body is not None:
+            response = self._client.open(path, method=method, data=json.dumps(body),
+                                         content_type='application/json', headers=headers)
+        else:
+            response = self._client.open(path, method=method, data=form, headers=headers)
+        return response.status_code, response.headers, response.data
+
+class HTTPClient(object):
+    ''' one keep-alive connection per client '''
+    def __init__(self, port):
+        self._connection = http.client.HTTPConnection('127.0.0.1', port)
+
+    def request(self, method, path, body=None, headers={}, form=None):
+        headers = dict(headers)
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            body = urllib.parse.urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self._connection.request(method, path, body, headers)
+        response = self._connection.getresponse()
+        return response.status, response.headers, response.read()
+
+def serveTornado(app, threads, control=None):
+    ''' run app behind wsgipool.WSGIHandler on a free port of its own IOLoop thread, returns the port '''
+    import asyncio
+    import logging
+    from tornado.httpserver import HTTPServer
+    from tornado.netutil import bind_sockets
+    from tornado.web import Application
+    import wsgipool
+    logging.getLogger('tornado.access').setLevel(logging.ERROR) # the 4xx of the workload are expected
+    sockets = bind_sockets(0, '127.0.0.1')
+    ready = threading.Event()
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        server = HTTPServer(Application([(r'.*', wsgipool.WSGIHandler,
+                                          dict(wsgi_app=app, executor=ThreadPoolExecutor(threads), admission=control))]))
+        server.add_sockets(sockets)
+        ready.set()
+        asyncio.get_event_loop().run_forever()
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return sockets[0].getsockname()[1]
+
+#### Workload ####
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {} # route -> [seconds]
+        self.errors = {} # route -> count
+
+    def call(self, client, method, path, body=None, headers={}, expect=(200,)):
+        start = time.perf_counter()
+        status, response_headers, data = client.request(method, path, body, headers)
+        elapsed = time.perf_counter() - start
+        route = routeOf(method, path.split('?')[0])
+        with self.lock:
+            self.latency.setdefault(route, []).append(elapsed)
+            if status not in expect:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return status, response_headers, data
+
+def table(recorder, client, table_id, code, meal_ids, args, rng):
+    recorder.call(client, 'GET', '/QR/%d' % table_id)
+    recorder.call(client, 'GET', '/orders/' + code)
+    etag = None
+    for round in range(args.rounds):
+        headers = dict(XHR, **({'If-None-Match': etag} if etag else {}))
+        status, headers, data = recorder.call(client, 'GET', '/meals/', headers=headers, expect=(200, 304))
+        etag = headers.get('ETag') or etag
+        meals = [{'id': meal_id, 'amount': rng.randint(1, 3), 'comment': ''}
+                 for meal_id in rng.sample(meal_ids, rng.randint(1, len(meal_ids)))]
+        recorder.call(client, 'POST', '/orders/' + code, {'meals': meals})
+        for poll in range(args.polls):
+            recorder.call(client, 'GET', '/orders/' + code, headers=XHR, expect=(200, 404))
+
+def kitchen(recorder, client, tables_done, table_ids, rng):
+    ''' advance what is on screen until every table has ordered and is checked out '''
+    while True:
+        status, headers, data = recorder.call(client, 'GET', '/delivery/', headers=XHR, expect=(200, 404))
+        orders = json.loads(data.decode('utf-8')).get('orders', []) if status == 200 else []
+        for order in orders:
+            recorder.call(client, 'PUT', '/delivery/%d?state_id=%d' % (order['id'], order['state_id']),
+                          headers=XHR, expect=(200, 404, 409)) # 404 once a checkout archived it
+        ready = set(order['table_id'] for order in orders)
+        for table_id in rng.sample(table_ids, min(len(table_ids), 3)):
+            if table_id not in ready:
+                recorder.call(client, 'DELETE', '/delivery/%d' % table_id, headers=XHR, expect=(200, 405, 409))
+        if not orders:
+            if tables_done.is_set():
+                for table_id in table_ids: # whatever is served and not paid yet
+                    recorder.call(client, 'DELETE', '/delivery/%d' % table_id, headers=XHR, expect=(200, 405, 409))
+                return
+            time.sleep(0.01) # an empty screen polls again shortly
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=('client', 'tornado'), default='client')
+    parser.add_argument('--tables', type=int, default=20)
+    parser.add_argument('--kitchens', type=int, default=2)
+    parser.add_argument('--rounds', type=int, default=5, help='orders per table')
+    parser.add_argument('--polls', type=int, default=3, help='status polls after each order')
+    parser.add_argument('--threads', type=int, default=8, help='WSGIHandler threads in tornado mode')
+    parser.add_argument('--admission', action='store_true', help='admission control in tornado mode')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='print the change against the results in this file')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix='pay-bench-'))
+    import pay
+    pay.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath('test.db')
+    pay.app.config['WTF_CSRF_ENABLED'] = False
+    pay.lcdShow = lambda msg: None
+    statements = StatementCounter(pay.app.wsgi_app)
+    pay.app.wsgi_app = statements
+
+    control = None
+    if args.mode == 'tornado':
+        if args.admission:
+            import admission
+            control = admission.fromConfig(pay.app.config, args.threads)
+        port = serveTornado(pay.app, args.threads, control)
+        makeClient = lambda: HTTPClient(port)
+    else:
+        makeClient = lambda: TestClient(pay.app)
+    setup = makeClient()
+    setup.request('PUT', '/init/', headers=XHR)
+    setup.request('DELETE', '/init/', headers=XHR)
+    setup.request('POST', '/QR/%d' % args.tables, form={'description': ''})
+    tables = json.loads(setup.request('GET', '/QR/', headers=XHR)[2].decode('utf-8'))['tables']
+    tables = [(t['id'], t['orderUrl'].rsplit('/', 1)[1]) for t in tables][:args.tables]
+    meal_ids = [m['id'] for m in json.loads(setup.request('GET', '/meals/', headers=XHR)[2].decode('utf-8'))['meals']]
+    statements.statements.clear()
+
+    recorder = Recorder()
+    tables_done = threading.Event()
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.tables + args.kitchens) as pool:
+        screens = [pool.submit(kitchen, recorder, makeClient(), tables_done, [t[0] for t in tables],
+                               random.Random(rng.random())) for i in range(args.kitchens)]
+        customers = [pool.submit(table, recorder, makeClient(), table_id, code, meal_ids, args,
+                                 random.Random(rng.random())) for table_id, code in tables]
+        for future in customers:
+            future.result()
+        tables_done.set()
+        for future in screens:
+            future.result()
+    duration = time.perf_counter() - start
+
+    routes = {}
+    for route, latency in sorted(recorder.latency.items()):
+        latency.sort()
+        count, executed = statements.statements.get(route, [0, 0])
+        routes[route] = {
+            'requests': len(latency),
+            'errors': recorder.errors.get(route, 0),
+            'throughput': len(latency) / duration,
+            'p50_ms': percentile(latency, 50) * 1000,
+            'p95_ms': percentile(latency, 95) * 1000,
+            'p99_ms': percentile(latency, 99) * 1000,
+            'statements': executed / count if count else None,
+        }
+    total = sum(r['requests'] for r in routes.values())
+    results = {'mode': args.mode, 'tables': args.tables, 'kitchens': args.kitchens, 'rounds': args.rounds,
+               'polls': args.polls, 'duration_s': duration, 'requests': total,
+               'throughput': total / duration, 'routes': routes}
+
+    print('%s: %d requests in %.2fs, %.0f req/s' % (args.mode, total, duration, total / duration))
+    print('%-16s %7s %6s %8s %8s %8s %8s %6s' % ('route', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'sql'))
+    for route, r in routes.items():
+        print('%-16s %7d %6d %8.1f %8.2f %8.2f %8.2f %6s' % (route, r['requests'], r['errors'], r['throughput'],
+              r['p50_ms'], r['p95_ms'], r['p99_ms'], '-' if r['statements'] is None else '%.1f' % r['statements']))
+    if control:
+        results['admission'] = {'admitted': dict(control.admitted),
+                                'rejected': dict(('%s %s' % key, count) for key, count in control.rejected.items())}
+        print('admitted %s' % ', '.join('%s %d' % item for item in control.admitted.items()))
+        print('rejected %s' % (', '.join('%s %s %d' % (name, reason, count)
+                                         for (name, reason), count in control.rejected.items() if count) or 'none'))
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print('against %s: %+.1f%% req/s' % (args.compare, (results['throughput'] / old['throughput'] - 1) * 100))
+        for route, r in routes.items():
+            if route in old['routes']:
+                before = old['routes'][route]
+                print('%-16s p95 %8.2f -> %8.2f ms, sql %s -> %s' % (route, before['p95_ms'], r['p95_ms'],
+                      before['statements'], r['statements']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
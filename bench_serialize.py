@@ -0,0 +1,83 @@
+''' The row tuple serializers of the list endpoints against the marshmallow schemas
+
+    python bench_serialize.py [--rows 10 100 1000] [--repeat 20] [--json out.json]
+
+Each case is the query and the JSON body, timed for both paths on the same rows of a
+fresh database in a temporary directory. Exits 1 if the two bodies differ.
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+def best(function, repeat):
+    ''' the fastest of repeat calls, in seconds, and the result '''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix='pay-bench-'))
+    import pay
+    from flask import jsonify
+    pay.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath('test.db')
+    most = max(args.rows)
+    with pay.app.test_request_context(headers={'X-Requested-With': 'XMLHttpRequest'}):
+        pay.setupDatabase()
+        session = pay.db.session
+        session.add_all([pay.State(name) for name in ('已下訂', '準備中', '已出餐', '已結帳')])
+        session.bulk_insert_mappings(pay.Meal, [dict(name='餐點 "%d"' % i, price=i % 90 + 10) for i in range(most)])
+        for i in range(most):
+            session.add(pay.Table('第 %d 桌' % i))
+        session.flush()
+        session.bulk_insert_mappings(pay.Order, [dict(table_id=i % most + 1, meal_id=i % most + 1, amount=i % 3 + 1,
+                price=i % 90 + 10, comment='不要洋蔥' if i % 2 else '', state_id=i % 3 + 1) for i in range(most)])
+        session.commit()
+
+        cases = {
+            'orders': (lambda n: jsonify({'orders': pay.orders_schema.dump(pay.listOrders(limit=n)).data,
+                                          'next_after_id': None}).get_data(),
+                       lambda n: ('{"next_after_id":null,"orders":%s}\n' % pay.ORDER_ROWS.encode(
+                                          pay.orderRows(limit=n))).encode('ascii')),
+            'meals': (lambda n: jsonify({'meals': pay.meals_schema.dump(session.query(pay.Meal).limit(n).all()).data}).get_data(),
+                      lambda n: ('{"meals":%s}\n' % pay.MEAL_ROWS.encode(session.query(pay.Meal.id, pay.Meal.name,
+                                 pay.Meal.price).limit(n).all(), meal=pay.urlPrefix('.meals', meals_id=0))).encode('ascii')),
+            'tables': (lambda n: jsonify({'tables': pay.tables_schema.dump(session.query(pay.Table).limit(n).all()).data}).get_data(),
+                       lambda n: ('{"tables":%s}\n' % pay.TABLE_ROWS.encode(session.query(pay.Table.id, pay.Table.description,
+                                  pay.Table.code).limit(n).all(), qr=pay.urlPrefix('.qr', qr_id=0),
+                                  order='http://' + pay.serverHost() + pay.urlPrefix('.orders', orders_code='-'))).encode('ascii')),
+        }
+        results, ok = [], True
+        for name, (schema, rows) in cases.items():
+            for n in args.rows:
+                session.expunge_all()
+                slow, expected = best(lambda: schema(n), args.repeat)
+                fast, body = best(lambda: rows(n), args.repeat)
+                if body != expected:
+                    print('%s %d: the bodies differ' % (name, n), file=sys.stderr)
+                    ok = False
+                results.append({'case': name, 'rows': n, 'marshmallow_ms': slow * 1000, 'rows_ms': fast * 1000,
+                                'speedup': slow / fast})
+
+    print('%-8s %6s %15s %10s %8s' % ('case', 'rows', 'marshmallow ms', 'rows ms', 'speedup'))
+    for r in results:
+        print('%-8s %6d %15.3f %10.3f %7.1fx' % (r['case'], r['rows'], r['marshmallow_ms'], r['rows_ms'], r['speedup']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
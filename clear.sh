@@ -1,3 +1,3 @@
-rm -v ./templates/*.svg
-rm -v test.db
+rm -rv ./qr
+rm -v test.db*
 rm -v init.lck
@@ -1,4 +1,3 @@
-import smbus
 import socket
 import threading
 from time import *  
@@ -54,25 +53,58 @@ En = 0x04 # Enable bit
 Rw = 0x02 # Read/Write bit
 Rs = 0x01 # Register select bit
 
+# DDRAM address of the first cell of each row
+ROW_OFFSETS = [ 0x00, 0x40, 0x14, 0x54]
+
+# bytes per I2C block write, the SMBus limit is 32 data bytes after the first
+I2C_BLOCK = 32
+
+class SMBusBackend(object):
+    ''' What Lcd talks to: the SMBus byte and block calls, and sleep() for the delays the
+        HD44780 needs between commands. lcdsim.SimulatedBus is the same interface without a Pi.'''
+    def __init__(self, port):
+        import smbus
+        self._bus = smbus.SMBus(port)
+
+    def __getattr__(self, name):
+        return getattr(self._bus, name)
+
+    def sleep(self, seconds):
+        sleep(seconds)
 
 class Lcd:
-    def __init__(self, port, addr, col, row):
+    def __init__(self, port, addr, col, row, bus=None):
         self._addr = addr
-        self.bus = smbus.SMBus(port)  
+        self.bus = bus if bus is not None else SMBusBackend(port)
         self._col = col
         self._backlightval = LCD_NOBACKLIGHT
         self._row = row 
         self._displayfunction = LCD_4BITMODE | LCD_1LINE | LCD_5x8DOTS
+        self._frame = [' '] * (col * row) # shadow of the DDRAM cells on screen
+        self._cursor = None # (col, row) of the DDRAM address counter, None if unknown
         self.begin(col, row)
         
     def write(self, byte):
         self.send(byte, Rs)
+        if self._cursor and self._cursor[0] < self._col:
+            col, row = self._cursor
+            self._frame[row * self._col + col] = chr(byte)
+            self._cursor = (col + 1, row)
     def read(self):  
         return self.bus.read_byte(self._addr)  
     def read_nbytes_data(self, data, n): # For sequential reads > 1 byte  
         return self.bus.read_i2c_block_data(self._addr, data, n)  
     def printIIC(self, byte):
         self.bus.write_byte(self._addr, byte)
+    def writeIIC(self, data):
+        ''' send expander bytes in block transfers. Each byte takes 9 clocks on the bus, at 100-400kHz
+            that already exceeds the enable pulse width and the 37us a data write or set address takes '''
+        for i in range(0, len(data), I2C_BLOCK + 1):
+            chunk = data[i:i + I2C_BLOCK + 1]
+            if len(chunk) == 1:
+                self.bus.write_byte(self._addr, chunk[0])
+            else:
+                self.bus.write_i2c_block_data(self._addr, chunk[0], chunk[1:])
 
     def begin(self, cols, lines, dotsize = 0):
         self._autoscroll = True
@@ -87,11 +119,11 @@ class Lcd:
         # SEE PAGE 45/46 FOR INITIALIZATION SPECIFICATION!
         # according to datasheet, we need at least 40ms after power rises above 2.7V
         # before sending commands. Arduino can turn on way befer 4.5V so we'll wait 50
-        sleep(0.05)
+        self.bus.sleep(0.05)
         
         # Now we pull both RS and R/W low to begin commands
         self.expanderWrite( self._backlightval) # reset expanderand turn backlight off (Bit 8 =1)
-        sleep(1)
+        self.bus.sleep(1)
         
         
         # put the LCD into 4 bit mode
@@ -100,15 +132,15 @@ class Lcd:
     
         # we start in 8bit mode, try to set 4 bit mode
         self.write4bits(0x03 << 4)
-        sleep(0.0045) #wait min 4.1ms
+        self.bus.sleep(0.0045) #wait min 4.1ms
    
         # second try
         self.write4bits(0x03 << 4)
-        sleep(0.0045) #wait min 4.1ms
+        self.bus.sleep(0.0045) #wait min 4.1ms
    
         # third go!
         self.write4bits(0x03 << 4) 
-        sleep(0.00015)
+        self.bus.sleep(0.00015)
               
         # finally, set to 4-bit interface
         self.write4bits(0x02 << 4) 
@@ -134,16 +166,19 @@ class Lcd:
     ## HIGH LEVEL COMMANDS ##
     def clear(self):
         self.command(LCD_CLEARDISPLAY)
-        sleep(0.002)
+        self.bus.sleep(0.002)
+        self._frame = [' '] * (self._col * self._row)
+        self._cursor = (0, 0)
         
     def home(self):
         self.command(LCD_RETURNHOME)
-        sleep(0.002)
+        self.bus.sleep(0.002)
+        self._cursor = (0, 0)
 
     def setCursor(self, col, row):
-        row_offsets = [ 0x00, 0x40, 0x14, 0x54]
         row = self._numlines if row > self._numlines else row
-        self.command(LCD_SETDDRAMADDR | (col + row_offsets[row]) );
+        self.command(LCD_SETDDRAMADDR | (col + ROW_OFFSETS[row]) );
+        self._cursor = (col, row)
 
     # Turn the display on/off (quickly)
     def display(self, boolean = True):
@@ -212,6 +247,7 @@ class Lcd:
     def createChar(self, location, bCharMap):
         location &= 0x07
         self.command(LCD_SETCGRAMADDR | (location << 3));
+        self._cursor = None
         for i in range(8):
             self.write(charmap[i])
 
@@ -240,13 +276,21 @@ class Lcd:
         lownib= (value << 4 ) & 0xf0
         self.write4bits( (highnib)|mode )
         self.write4bits( (lownib)|mode ) 
+
+    def sendBytes(self, value, mode):
+        ''' the expander bytes send() writes one by one: data, En high, En low for each nibble '''
+        out = []
+        for nib in (value & 0xf0, (value << 4) & 0xf0):
+            data = nib | mode | self._backlightval
+            out += [data, data | En, data & ~En]
+        return out
         
     def pulseEnable(self, data):
         self.expanderWrite( data | En)  #En high
-        sleep(0.000001)     #enable pulse must be >450ns
+        self.bus.sleep(0.000001)     #enable pulse must be >450ns
         
         self.expanderWrite( data & ~En);    #En low
-        sleep(0.00005)
+        self.bus.sleep(0.00005)
             
     def expanderWrite(self, data):
         self.printIIC( data | self._backlightval)
@@ -257,75 +301,144 @@ class Lcd:
         if len(line) + row *self._col  + col > self._col * self._row:
             self.print("OverFlow")           
             return -1
-        if clear:
-            self.clear()
         if backlight and self._backlightval is LCD_NOBACKLIGHT:
             self.backlight()
         if not backlight and self._backlightval is LCD_BACKLIGHT:
             self.backlight(False)
         if not self._autoscroll:
             self.autoscroll()
-        if col is 0 and row is 0:
-            self.home()
-        else:
-            self.setCursor(col, row)
-        for i in range(len(line)):
-            if not (i + col) % self._col:
-                self.setCursor(0, (i + col) // self._col)
-            self.write(ord(line[i]))
+        # clear by blanking the frame, render() only sends the cells that really change
+        frame = [' '] * (self._col * self._row) if clear else list(self._frame)
+        start = row * self._col + col
+        frame[start:start + len(line)] = line
+        self.render(frame)
+
+    def render(self, frame):
+        ''' bring the display to frame, a string or list of col*row characters, sending only
+            the changed runs of cells and moving the cursor only where a run does not follow it '''
+        out = []
+        for row in range(self._row):
+            base = row * self._col
+            dirty = [frame[base + i] != self._frame[base + i] for i in range(self._col)]
+            col = 0
+            while col < self._col:
+                if not dirty[col]:
+                    col += 1
+                    continue
+                end = col + 1
+                # rewriting one unchanged cell costs the same 6 bytes as moving the cursor past it
+                while end < self._col and (dirty[end] or end + 1 < self._col and dirty[end + 1]):
+                    end += 1
+                if self._cursor != (col, row):
+                    out += self.sendBytes(LCD_SETDDRAMADDR | (col + ROW_OFFSETS[row]), 0)
+                for i in range(base + col, base + end):
+                    out += self.sendBytes(ord(frame[i]) & 0xff, Rs)
+                    self._frame[i] = frame[i]
+                self._cursor = (end, row)
+                col = end
+        if out:
+            self.writeIIC(out)
 
         
+# LoopDisplay settings
+MAX_MESSAGES = 16 # pending messages kept, the lowest priority, oldest one is dropped beyond it
+IP_REFRESH = 300 # seconds between host ip lookups
+
 class LoopDisplay( threading.Thread ):
-    ''' Continue showing Message(msg) in queue, if msg is None, then showing IP + Time'''
+    ''' Continue showing Message(msg) in queue, if msg is None, then showing IP + Time.
+        Messages wait in a bounded priority queue, a message shown again while it is still waiting
+        (same key, the text by default) is merged into the waiting one instead of queued twice.'''
     __regist = {} # store each I2C device, Key is a tuple (I2C_Port, I2C_Address), ex: (1, 0x27)
 
-    def __new__(clz, port, addr, col=16, row=2 ):
+    def __new__(clz, port, addr, col=16, row=2, bus=None):
         if (port, addr) in LoopDisplay.__regist:
             return LoopDisplay.__regist[(port, addr)]
         return object.__new__(clz)
 
-    def __init__(self, port, addr, col=16, row=2):
+    def __init__(self, port, addr, col=16, row=2, bus=None):
         if (port, addr) not in LoopDisplay.__regist:
             super(LoopDisplay, self).__init__()
-            self.setLcd(port, addr,  col, row)
+            self.daemon = True
+            self._cond = threading.Condition()
+            self._msg = {} # key -> [priority, sequence, message, timeToShow]
+            self._seq = 0
+            self._ip = None
+            self._ipTime = 0
+            self.setLcd(port, addr,  col, row, bus)
             self._presentMsg = None 
             self.start()
             LoopDisplay.__regist[(port, addr)] = self 
                     
     def __del__(self):
-        self.print("", clear=True)
         self.exit()
-        self.lcd = None
         
-    def setLcd(self, port, addr, col, row):
-        self.lcd = Lcd( port, addr, col, row)
-        self._msg = [] # Queue of List to show, each Element is ( Message, timeToShow), ex: ("msg", 5)
+    def exit(self):
+        with self._cond:
+            self.lcd = None
+            self._cond.notify()
+
+    def setLcd(self, port, addr, col, row, bus=None):
+        self.lcd = Lcd( port, addr, col, row, bus)
         self._col = col
         
-    def show( self, msg, showSec=5):
-        self._msg.append((msg, showSec))
+    def show( self, msg, showSec=5, priority=0, key=None):
+        ''' queue msg for showSec seconds, higher priority first, then in the order shown '''
+        key = msg if key is None else key
+        with self._cond:
+            if key in self._msg:
+                pending = self._msg[key]
+                pending[0] = max(pending[0], priority)
+                pending[2:] = [msg, showSec]
+            else:
+                if len(self._msg) >= MAX_MESSAGES:
+                    lowest = min(self._msg, key=lambda k: (self._msg[k][0], self._msg[k][1]))
+                    if self._msg[lowest][0] > priority:
+                        return
+                    del self._msg[lowest]
+                self._seq += 1
+                self._msg[key] = [priority, self._seq, msg, showSec]
+            self._cond.notify()
+
+    def next(self, timeout):
+        ''' the next message and its seconds to show, None if none came within timeout '''
+        with self._cond:
+            if not self._msg and self.lcd:
+                self._cond.wait(timeout)
+            if not self._msg:
+                return None
+            key = max(self._msg, key=lambda k: (self._msg[k][0], -self._msg[k][1]))
+            return self._msg.pop(key)[2:]
+
+    def hostIp(self):
+        if self._ip is None or monotonic() - self._ipTime > IP_REFRESH:
+            try:
+                self._ip = socket.gethostbyname(socket.gethostname())
+            except socket.error:
+                self._ip = self._ip or '0.0.0.0'
+            self._ipTime = monotonic()
+        return self._ip
         
     def run(self):
         while self.lcd:
-            if self._msg:
-                if self._msg[0][0] != self._presentMsg:
-                    self.lcd.print(self._msg[0][0])
-                    self._showInSec = self._msg[0][1] 
-                self._showInSec -= 1 
-                self._presentMsg = self._msg[0][0]
-                if not self._showInSec: del self._msg[0]
+            # wake for a new message, or at the next second for the clock
+            msg = self.next(1 - datetime.now().microsecond / 1000000.0)
+            lcd = self.lcd
+            if not lcd:
+                break
+            if msg:
+                self._presentMsg = msg[0]
+                lcd.print(msg[0])
+                with self._cond:
+                    self._cond.wait_for(lambda: not self.lcd, msg[1])
             else:
-                ip = socket.gethostbyname(socket.gethostname())
-                if len(ip) < self._col:
-                    ip += ' ' *  (self._col - len(ip)) 
-                time = ' ' * (self._col - 8) + datetime.now().isoformat()[11:19]
-                out = ip + time
-                if self._presentMsg:
-                    for i in range(len(out)):
-                        if i == len(self._presentMsg) or out[i] != self._presentMsg[i]:
-                            self.lcd.print( out[i:], col=i , clear=False, backlight=False)
-                            break
-                else:
-                    self.lcd.print( out, backlight=False) 
-                self._presentMsg = out
-            sleep(1)
+                self.tick(lcd)
+
+    def tick(self, lcd, now=None):
+        ''' show IP + Time, only the changed digits are sent '''
+        ip = self.hostIp()
+        if len(ip) < self._col:
+            ip += ' ' *  (self._col - len(ip)) 
+        time = ' ' * (self._col - 8) + (now or datetime.now()).isoformat()[11:19]
+        out = ip + time
+        lcd.print( out, backlight=False)
+        self._presentMsg = out
@@ -0,0 +1,139 @@
+''' A simulated PCF8574 I2C expander driving an HD44780 in 4 bit mode, usable as the bus of lcd.Lcd '''
+import time
+
+# expander bits, as wired on the backpack lcd.py talks to
+En = 0x04
+Rs = 0x01
+BACKLIGHT = 0x08
+
+# execution times the HD44780 datasheet mandates, in microseconds
+CLEAR_US = 1520 # clear display, return home
+INSTRUCTION_US = 37 # every other instruction and data write
+INIT_US = [4100, 100] # after the first and second 8 bit function set of the power on sequence
+
+class SimulatedBus(object):
+    ''' Records every byte written (one I2C transaction per write call), every enable pulse, the
+        delay the controller needs after each instruction and the delays Lcd sleeps, and keeps the
+        resulting DDRAM. Nothing really sleeps unless realtime is set.'''
+
+    def __init__(self, port=1, realtime=False):
+        self.realtime = realtime
+        self.reset()
+        self.ddram = [ord(' ')] * 0x80
+        self.address = 0
+        self.increment = 1
+        self.fourbit = False
+        self.twoline = False
+        self.backlight = False
+        self.display = False
+        self._port = 0
+        self._nibble = None
+        self._initSteps = 0
+
+    def reset(self):
+        ''' zero the counters, the display contents stay '''
+        self.transactions = 0
+        self.bytes = 0
+        self.pulses = 0
+        self.required_us = 0 # the controller execution times, by the datasheet
+        self.slept = 0.0 # the delays Lcd asked for, in seconds
+        self.sleeps = 0
+        self.log = []
+
+    def sleep(self, seconds):
+        self.sleeps += 1
+        self.slept += seconds
+        if self.realtime:
+            time.sleep(seconds)
+
+    # SMBus interface
+    def write_byte(self, addr, byte):
+        self.transactions += 1
+        self._write(byte)
+
+    def write_i2c_block_data(self, addr, cmd, data):
+        self.transactions += 1
+        self._write(cmd)
+        for byte in data:
+            self._write(byte)
+
+    def read_byte(self, addr):
+        return self._port
+
+    def read_i2c_block_data(self, addr, cmd, n):
+        return [self._port] * n
+
+    # display contents
+    def lines(self, col=16, row=2):
+        offsets = [0x00, 0x40, 0x14, 0x54]
+        return [''.join(chr(c) for c in self.ddram[offsets[r]:offsets[r] + col]) for r in range(row)]
+
+    def text(self, col=16, row=2):
+        return '\n'.join(self.lines(col, row))
+
+    def _write(self, byte):
+        self.bytes += 1
+        self.log.append(byte)
+        self.backlight = bool(byte & BACKLIGHT)
+        if self._port & En and not byte & En: # the controller latches on the falling edge
+            self.pulses += 1
+            self._latch(self._port & 0xf0, self._port & Rs)
+        self._port = byte
+
+    def _latch(self, nibble, rs):
+        if not self.fourbit: # 8 bit mode, D3-D0 are not wired and read as 0
+            self._execute(nibble, rs)
+        elif self._nibble is None:
+            self._nibble = nibble
+        else:
+            value = self._nibble | (nibble >> 4)
+            self._nibble = None
+            self._execute(value, rs)
+
+    def _execute(self, value, rs):
+        if rs:
+            self.ddram[self.address] = value
+            self._move(self.increment)
+            self.required_us += INSTRUCTION_US
+        elif value & 0x80: # set DDRAM address
+            self.address = value & 0x7f
+            self.required_us += INSTRUCTION_US
+        elif value & 0x40: # set CGRAM address, not simulated
+            self.required_us += INSTRUCTION_US
+        elif value & 0x20: # function set
+            if not self.fourbit and self._initSteps < len(INIT_US):
+                self.required_us += INIT_US[self._initSteps]
+                self._initSteps += 1
+            else:
+                self.required_us += INSTRUCTION_US
+            self.fourbit = not value & 0x10
+            self.twoline = bool(value & 0x08)
+        elif value & 0x10: # cursor or display shift
+            self.required_us += INSTRUCTION_US
+        elif value & 0x08: # display control
+            self.display = bool(value & 0x04)
+            self.required_us += INSTRUCTION_US
+        elif value & 0x04: # entry mode
+            self.increment = 1 if value & 0x02 else -1
+            self.required_us += INSTRUCTION_US
+        elif value & 0x02: # return home
+            self.address = 0
+            self.required_us += CLEAR_US
+        elif value & 0x01: # clear display
+            self.ddram = [ord(' ')] * 0x80
+            self.address = 0
+            self.increment = 1
+            self.required_us += CLEAR_US
+
+    def _move(self, step):
+        # in 2 line mode the rows are 0x00-0x27 and 0x40-0x67
+        if self.twoline:
+            position = (self.address & 0x3f) + step
+            row = self.address & 0x40
+            if position > 0x27:
+                position, row = 0, row ^ 0x40
+            elif position < 0:
+                position, row = 0x27, row ^ 0x40
+            self.address = row | position
+        else:
+            self.address = (self.address + step) % 0x50
@@ -1,15 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
-import pay
+from tornado.log import app_log
+from tornado.netutil import bind_sockets
+from tornado.options import define, options, parse_command_line
+from tornado.process import fork_processes, task_id
+from tornado.web import Application, FallbackHandler
+import admission
 import lcd
+import push
+import re
 import socket
+import staticfiles
+import threading
+import time
+import wsgipool
 
-I2CLCD = lcd.LoopDisplay(1,0x27)
-pay.lcdShow = I2CLCD.show
+define('port', default=5000, help='listen on this port')
+define('threads', default=8, help='run Flask requests on this many threads, 0 runs them on the IOLoop')
+define('processes', default=1, help='fork this many processes sharing the port, 0 means one per CPU')
+define('admission', default=True, help='limit the requests of each route class waiting for a thread, see ADMISSION_LIMITS')
+define('lcd', default=True, help='show messages on the I2C LCD at 0x27 of bus 1')
+
+class Startup(object):
+    ''' wall time of each startup phase, logged by report() '''
+    def __init__(self):
+        self._start = time.monotonic()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start))
+
+    def report(self):
+        app_log.info('startup %s, ready after %.0fms', ', '.join('%s %.0fms' % (name, seconds * 1000)
+                     for name, seconds in self.phases), (time.monotonic() - self._start) * 1000)
+
+def createApplication(app, threads, control=None):
+    ''' the Tornado application serving static files, kitchen events and the Flask app,
+        with control, an admission.Admission, in front of the threads '''
+    if threads:
+        flask = (r'.*', wsgipool.WSGIHandler, dict(wsgi_app=app, executor=ThreadPoolExecutor(threads), admission=control))
+    else:
+        flask = (r'.*', FallbackHandler, dict(fallback=WSGIContainer(app)))
+    return Application([
+        (r'/static/(.*)', staticfiles.StaticHandler, dict(path='static')),
+        (r'(?:%s/[^/]+)?/events/' % re.escape(app.config['STORE_PREFIX']), push.EventHandler,
+         dict(hub=push.hub, channel=lambda request: pay.app_stores.resolve(request.host, request.path)[0])),
+        flask,
+    ])
+
+def startDisplay(startup):
+    ''' Lcd.begin() takes over a second, and there may be no display at all: messages are dropped until it is up '''
+    with startup.phase('lcd'):
+        try:
+            display = lcd.LoopDisplay(1, 0x27)
+        except Exception as e: # no smbus module, no /dev/i2c-1 or nothing answering at 0x27
+            app_log.warning('no LCD, messages are not shown: %s', e)
+            return
+    pay.lcdShow = display.show
+    display.show("Webserver start  " + pay.SERVER_IP)
+
+def warmUp(startup, display):
+    ''' after the port is open: the schema check and the display, then the timing report '''
+    if display:
+        lcdThread = threading.Thread(target=startDisplay, args=(startup,), daemon=True)
+        lcdThread.start()
+    if not pay.schema_ready.is_set():
+        with startup.phase('database'):
+            pay.setupDatabase()
+    if display:
+        lcdThread.join()
+    startup.report()
+
+startup = Startup()
+parse_command_line()
+
+with startup.phase('bind'):
+    sockets = bind_sockets(options.port)
+with startup.phase('import'):
+    import pay
+if options.processes != 1:
+    with startup.phase('database'): # once, before the workers race for it
+        pay.setupDatabase()
+    fork_processes(options.processes)
+    pay.db.engine.dispose() # never share the connections opened before fork
+else: # each process has its own hub, a screen would only get the events of the process it is connected to
+    pay.app.config['PUSH_EVENTS'] = True
+    pay.pushEvent = lambda event, data: push.hub.publish(event, data, pay.store().name)
+
+pay.lcdShow = lambda msg: None
 #pay.SERVER_IP = socket.gethostbyname(socket.gethostname())
 pay.SERVER_IP = '219.85.47.171:5000'
-I2CLCD.show("Webserver start  " + pay.SERVER_IP) 
-http_server = HTTPServer(WSGIContainer(pay.app))
-http_server.listen(5000)
+with startup.phase('listen'):
+    control = admission.fromConfig(pay.app.config, options.threads) if options.admission and options.threads else None
+    if control:
+        pay.app_metrics.collect(control.render)
+    http_server = HTTPServer(createApplication(pay.app, options.threads, control))
+    http_server.add_sockets(sockets)
+    push.hub.start()
+# only one process owns the I2C bus
+threading.Thread(target=warmUp, args=(startup, options.lcd and not task_id()), daemon=True).start()
 IOLoop.instance().start()
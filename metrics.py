@@ -0,0 +1,192 @@
+import collections
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        # counts are cumulative as the format wants them, each bucket holds the values up to its bound
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+def labels(**values):
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in sorted(values.items())) + '}'
+
+def histogramLines(name, help, series):
+    ''' the text format of [(labels dict, Histogram)] '''
+    out = ['# HELP %s %s' % (name, help), '# TYPE %s histogram' % name]
+    for key, h in sorted(series, key=lambda s: sorted(s[0].items())):
+        for bound, count in zip(h.buckets, h.counts):
+            out.append('%s_bucket%s %d' % (name, labels(le=bound, **key), count))
+        out.append('%s_bucket%s %d' % (name, labels(le='+Inf', **key), h.count))
+        out.append('%s_sum%s %.6f' % (name, labels(**key), h.sum))
+        out.append('%s_count%s %d' % (name, labels(**key), h.count))
+    return out
+
+class Metrics(object):
+    ''' Latency, SQL and phase timings of each request of app, rendered in the Prometheus text format.
+        SQL is counted on the thread serving the request, writes on the single writer thread are not.
+        arm() runs the next request (under a path prefix) in cProfile, its stats are kept as profile.'''
+
+    def __init__(self, app, slow=0.5, samples=20, directory='profiles'):
+        self._slow = slow
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._requests = collections.defaultdict(lambda: Histogram(SECONDS)) # (endpoint, method) -> seconds
+        self._status = collections.Counter() # (endpoint, method, status) -> requests
+        self._queries = collections.defaultdict(lambda: Histogram(QUERIES)) # endpoint -> statements
+        self._sql = collections.defaultdict(lambda: Histogram(SECONDS)) # endpoint -> seconds in SQL
+        self._phases = collections.defaultdict(lambda: Histogram(SECONDS)) # (phase, name) -> seconds
+        self._samples = collections.deque(maxlen=samples) # the latest slow requests
+        self._armed = None # path prefix of the request to profile
+        self.profile = None
+        self._collectors = [] # functions returning more lines for render()
+        app.before_request(self._begin)
+        app.after_request(self._response)
+        app.teardown_request(self._end)
+        event.listen(Engine, 'before_cursor_execute', self._beforeQuery)
+        event.listen(Engine, 'after_cursor_execute', self._afterQuery)
+
+    #### Request lifecycle ####
+    def _begin(self):
+        record = self._local.record = {'start': time.perf_counter(), 'queries': 0, 'sql': 0.0, 'status': 500,
+                                       'phases': collections.Counter(), 'profiler': None}
+        armed = self._armed
+        if armed is not None and request.path.startswith(armed) and not request.path.startswith('/metrics'):
+            with self._lock:
+                if self._armed is None: return # another thread took it
+                self._armed = None
+            record['profiler'] = cProfile.Profile()
+            record['profiler'].enable()
+
+    def _response(self, response):
+        record = getattr(self._local, 'record', None)
+        if record: record['status'] = response.status_code
+        return response
+
+    def _end(self, exc):
+        record = getattr(self._local, 'record', None)
+        if record is None: return
+        self._local.record = None
+        elapsed = time.perf_counter() - record['start']
+        if record['profiler']:
+            record['profiler'].disable()
+            self._saveProfile(record['profiler'], elapsed)
+        endpoint, method = request.endpoint or 'none', request.method
+        with self._lock:
+            self._requests[(endpoint, method)].observe(elapsed)
+            self._status[(endpoint, method, record['status'])] += 1
+            self._queries[endpoint].observe(record['queries'])
+            self._sql[endpoint].observe(record['sql'])
+            if elapsed >= self._slow:
+                self._samples.append(dict(method=method, path=request.full_path.rstrip('?'), status=record['status'],
+                                          seconds=elapsed, queries=record['queries'], sql=record['sql'],
+                                          at=int(time.time()), **dict(record['phases'])))
+
+    def _beforeQuery(self, conn, cursor, statement, parameters, context, executemany):
+        record = getattr(self._local, 'record', None)
+        if record: record['query'] = time.perf_counter()
+
+    def _afterQuery(self, conn, cursor, statement, parameters, context, executemany):
+        record = getattr(self._local, 'record', None)
+        if record and 'query' in record:
+            record['queries'] += 1
+            record['sql'] += time.perf_counter() - record.pop('query')
+
+    #### Phases ####
+    @contextmanager
+    def phase(self, phase, name=''):
+        ''' time a part of the request: serialize, template, lcd ... '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            record = getattr(self._local, 'record', None)
+            if record: record['phases'][phase] += elapsed
+            with self._lock:
+                self._phases[(phase, name)].observe(elapsed)
+
+    def timeSchema(self, name, schema):
+        ''' time each dump() of the marshmallow schema instance as phase serialize '''
+        dump = schema.dump
+        def timedDump(*args, **kwargs):
+            with self.phase('serialize', name):
+                return dump(*args, **kwargs)
+        schema.dump = timedDump
+        return schema
+
+    def timeTemplates(self, render_template):
+        ''' render_template timed as phase template, by template name '''
+        def timedRender(template_name, **context):
+            with self.phase('template', template_name):
+                return render_template(template_name, **context)
+        return timedRender
+
+    #### Profiling ####
+    def arm(self, path='/'):
+        self._armed = path
+
+    def _saveProfile(self, profiler, elapsed):
+        out = io.StringIO()
+        out.write('%s %s %.1fms\n' % (request.method, request.full_path.rstrip('?'), elapsed * 1000))
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        self.profile = out.getvalue()
+        if self._directory:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            profiler.dump_stats(os.path.join(self._directory, '%d-%s.prof' % (time.time(), request.endpoint)))
+
+    #### Prometheus text format ####
+    def collect(self, lines):
+        ''' add the lines() of another part of the server to render() '''
+        self._collectors.append(lines)
+
+    def render(self):
+        out = []
+        def histogram(name, help, series):
+            out.extend(histogramLines(name, help, series))
+        with self._lock:
+            histogram('pay_request_seconds', 'Request latency by endpoint.',
+                      [(dict(endpoint=e, method=m), h) for (e, m), h in self._requests.items()])
+            out.append('# HELP pay_requests_total Requests by endpoint and status.')
+            out.append('# TYPE pay_requests_total counter')
+            for (endpoint, method, status), count in sorted(self._status.items()):
+                out.append('pay_requests_total%s %d' % (labels(endpoint=endpoint, method=method, status=status), count))
+            histogram('pay_request_sql_queries', 'SQL statements per request.',
+                      [(dict(endpoint=e), h) for e, h in self._queries.items()])
+            histogram('pay_request_sql_seconds', 'Time in SQL per request.',
+                      [(dict(endpoint=e), h) for e, h in self._sql.items()])
+            histogram('pay_phase_seconds', 'Time in serialization, templates and the LCD.',
+                      [(dict(phase=p, name=n), h) for (p, n), h in self._phases.items()])
+            out.append('# HELP pay_slow_request_seconds Latest requests slower than %gs.' % self._slow)
+            out.append('# TYPE pay_slow_request_seconds gauge')
+            for sample in self._samples:
+                sample = dict(sample)
+                seconds = sample.pop('seconds')
+                sample = dict((key, '%.6f' % value if isinstance(value, float) else value) for key, value in sample.items())
+                out.append('pay_slow_request_seconds%s %.6f' % (labels(**sample), seconds))
+        for lines in self._collectors:
+            out.extend(lines())
+        return '\n'.join(out) + '\n'
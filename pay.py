@@ -1,14 +1,37 @@
-from flask import Flask, make_response, request, render_template, jsonify, url_for
+from flask import Flask, Response, make_response, request, render_template, jsonify, url_for, stream_with_context
 from socket import gethostbyname, gethostname
-from jinja2 import Environment, FileSystemLoader 
+from jinja2 import Environment, FileSystemLoader, Markup
 
-from wtforms.ext.sqlalchemy.orm import model_form
 from flask_wtf import Form
 from wtforms import TextField
 from flask.ext.sqlalchemy import SQLAlchemy
+import sqlalchemy
+from sqlalchemy import and_, event, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy.pool import QueuePool
 from marshmallow import Schema, fields, ValidationError
+from werkzeug.local import LocalProxy
 
+from datetime import date, datetime
+import assets
+import codecs
+import csv
+import hashlib
+import io
+import json
+import metrics
+import os
+import qrcache
 import random
+import re
+import rowjson
+import sqlite3
+import stores
+import threading
+import time
+import writer
 
 app = Flask(__name__)
 
@@ -18,7 +41,64 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
 #app.config['SQLALCHEMY_ECHO'] = True
 app.config['SQLALCHEMY_ECHO'] = False 
 
+#### SQLite Settings ####
+# connections kept per process, 0 opens a new one for every session (NullPool)
+app.config['SQLALCHEMY_POOL_SIZE'] = 8
+app.config['SQLALCHEMY_MAX_OVERFLOW'] = 8
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = 10
+# run on every new connection, in this order; WAL lets readers go on while one writer commits
+app.config['SQLITE_PRAGMAS'] = [('busy_timeout', 5000), ('journal_mode', 'WAL'), ('synchronous', 'NORMAL')]
+# queue writes of orders(), delivery() and meals() to one thread committing them in batches
+app.config['SQLITE_SINGLE_WRITER'] = False
+# seconds a request waits for the single writer: a 503 if its write was not started, a 504 if it may still commit
+app.config['SQLITE_WRITER_TIMEOUT'] = 10
+
+#### Journal Settings ####
+# order events are appended to <database>.events.db, attached to every connection as the schema journal
+app.config['JOURNAL_SUFFIX'] = '.events.db'
+# the open orders are saved every JOURNAL_SNAPSHOT_EVERY events, replay.py starts from the latest snapshot
+app.config['JOURNAL_SNAPSHOT_EVERY'] = 1000
+app.config['JOURNAL_SNAPSHOTS_KEPT'] = 3
+
+#### QR Settings ####
+app.config['MAX_TABLES'] = 200
+app.config['QR_DIRECTORY'] = 'qr'
+
+#### Store Settings ####
+# each directory under STORES_DIRECTORY is a store with its own test.db, init.lck and qr/, served under
+# STORE_PREFIX/<name>/ or on the hosts STORE_HOSTS maps to it or <name>.STORE_DOMAIN ; any other request
+# goes to the default store of SQLALCHEMY_DATABASE_URI and QR_DIRECTORY
+app.config['STORES_DIRECTORY'] = 'stores'
+app.config['STORE_PREFIX'] = '/store'
+app.config['STORE_HOSTS'] = {} # host name -> store name
+app.config['STORE_DOMAIN'] = None
+# a store without requests for STORE_IDLE seconds closes its connections and threads, and so do the least
+# recently used idle ones when more than STORE_LIMIT are open
+app.config['STORE_IDLE'] = 600
+app.config['STORE_LIMIT'] = 32
+
+#### Admission Settings ####
+# main.py hands the threads to requests by route class: customer-write (orders POST and DELETE), customer-read
+# (orders GET and the menu), kitchen (delivery, kitchen and bill) and admin. A class may have this many
+# requests running or waiting for a thread, the next ones get a 503 with Retry-After at once
+app.config['ADMISSION_LIMITS'] = {'customer-write': 64, 'customer-read': 128, 'kitchen': 32, 'admin': 16}
+# a freed thread goes to the first class first, and ADMISSION_RESERVED threads only to it
+app.config['ADMISSION_PRIORITY'] = ['kitchen', 'customer-write', 'customer-read', 'admin']
+app.config['ADMISSION_RESERVED'] = 1
+# seconds a request may wait for a thread before its 503, and the Retry-After of the 503
+app.config['ADMISSION_TIMEOUT'] = 3
+app.config['ADMISSION_RETRY_AFTER'] = 2
+
+#### Metrics Settings ####
+# requests slower than this, in seconds, are kept as samples on /metrics
+app.config['METRICS_SLOW'] = 0.5
+# cProfile dumps of the requests armed by POST /metrics/profile
+app.config['METRICS_PROFILE_DIRECTORY'] = 'profiles'
+app_metrics = metrics.Metrics(app, app.config['METRICS_SLOW'], directory=app.config['METRICS_PROFILE_DIRECTORY'])
+render_template = app_metrics.timeTemplates(render_template)
+
 #### Jinja2 environment ####
+app.jinja_env.globals['assets'] = assets.urls # the bundles of static/build/, or their sources before a build
 env = Environment()
 env.loader = FileSystemLoader('./templates')
 
@@ -28,7 +108,51 @@ SERVER_IP="192.168.0.0"
 def lcdShow( msg ):
     I2CLCD.show(msg)
 
-db= SQLAlchemy(app)
+#### Kitchen push function ####
+pushEvent = None # main.py sets this to publish to the screens of the current store when served by Tornado
+# kitchen screens listen to /events/ only when main.py serves push from its single process, as every process
+# has its own hub; otherwise they reload their orders every POLL_INTERVAL seconds
+app.config['PUSH_EVENTS'] = False
+app.config['POLL_INTERVAL'] = 5
+
+def notifyKitchen( event, orders ):
+    if pushEvent and orders:
+        pushEvent(event, {'orders': orders_schema.dump(orders).data})
+
+class PaySQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite' and info.database not in (None, '', ':memory:') and options.get('pool_size'):
+            # pooled connections move between request threads
+            options['poolclass'] = QueuePool
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        super(PaySQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+    def get_engine(self, app, bind=None):
+        ''' the engine of the current store, sessions and create_all() follow it '''
+        if bind is None and store().uri:
+            return store().engine()
+        return super(PaySQLAlchemy, self).get_engine(app, bind)
+
+    def createEngine(self, app, uri):
+        ''' an engine set up as the one of SQLALCHEMY_DATABASE_URI '''
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, info, options)
+        return sqlalchemy.create_engine(info, **options)
+
+@event.listens_for(Engine, 'connect')
+def sqlitePragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        path = [row[2] for row in cursor.execute('PRAGMA database_list') if row[1] == 'main'][0]
+        cursor.execute('ATTACH DATABASE ? AS journal',
+                       (os.path.splitext(path)[0] + app.config['JOURNAL_SUFFIX'] if path else ':memory:',))
+        for name, value in app.config['SQLITE_PRAGMAS']:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+db= PaySQLAlchemy(app)
 
 #### Models ####
 class Meal(db.Model):
@@ -48,21 +172,36 @@ class Meal(db.Model):
     def url(self):
         return url_for('.meals', meals_id=self.id)
 
-MealForm= model_form(Meal, base_class=Form)
+MealForm = None
+
+def mealForm(*args, **kwargs):
+    ''' built on first use, wtforms.ext.sqlalchemy is only imported when a meal form is shown '''
+    global MealForm
+    if MealForm is None:
+        from wtforms.ext.sqlalchemy.orm import model_form
+        MealForm = model_form(Meal, base_class=Form)
+    return MealForm(*args, **kwargs)
 
 class Table(db.Model):
     __tablename__='table'
 
     id = db.Column(db.Integer, primary_key=True)
-    code = db.Column(db.String(3), nullable=False)
+    code = db.Column(db.String(3), nullable=False, unique=True, index=True)
     description = db.Column(db.String(50), nullable=False)
 
     def __init__(self, description):
-        code = ""
-        for i in range(3):
-            code += random.choice('abcdefghijklmnopqrstuvwxyz1234567890')
-        self.code = code
+        self.code = self.newCode()
         self.description = description
+
+    def newCode(self):
+        ''' a random code no other table has '''
+        while True:
+            code = ""
+            for i in range(3):
+                code += random.choice('abcdefghijklmnopqrstuvwxyz1234567890')
+            # autoflush puts tables pending in this session into the check too
+            if db.session.query(Table.id).filter(Table.code == code).first() is None:
+                return code
     
     def __repr__(self):
         if self.description:
@@ -70,7 +209,7 @@ class Table(db.Model):
         return str(self.id) + "(" + self.code + ")"
 
     def orderUrl(self):
-        return 'http://' + SERVER_IP + url_for( '.orders', orders_code=self.code)
+        return 'http://' + serverHost() + url_for( '.orders', orders_code=self.code)
 
     def url(self):
         return url_for('.qr', qr_id=self.id)
@@ -88,20 +227,24 @@ class State(db.Model):
 
 class Order(db.Model):
     __tablename__='order'
+    __table_args__ = {'sqlite_autoincrement': True} # ids of archived orders are never reused
     
     id = db.Column(db.Integer, primary_key=True)
-    table_id = db.Column(db.Integer, db.ForeignKey('table.id'))
+    table_id = db.Column(db.Integer, db.ForeignKey('table.id'), index=True)
     table = db.relationship("Table")
     meal_id = db.Column(db.Integer, db.ForeignKey('meal.id'))
     meal = db.relationship("Meal")
     amount = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Integer) # of the meal when ordered, later menu changes keep the bill
     comment = db.Column(db.String(50), nullable=False)
     state_id = db.Column(db.Integer, db.ForeignKey('state.id'))
     state = db.relationship("State")
+    created_at = db.Column(db.DateTime, default=datetime.utcnow) # NULL for orders of older versions
 
     def __init__( self, table, meal, amount=1, comment=''):
         self.table=table
         self.meal=meal 
+        self.price=meal.price if meal else None
         self.amount=amount
         self.comment=comment
         self.state_id=1
@@ -109,8 +252,214 @@ class Order(db.Model):
     def __repr__(self):
         return str(self.table_id) + str(self.meal_id) + str(self.amount) + str(self.comment)
 
+class OrderHistory(db.Model):
+    ''' Paid orders, moved out of order at checkout so the hot queries only see open ones '''
+    __tablename__='order_history'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False) # the id it had in order
+    table_id = db.Column(db.Integer, db.ForeignKey('table.id'), index=True)
+    table = db.relationship("Table")
+    meal_id = db.Column(db.Integer, db.ForeignKey('meal.id'))
+    meal = db.relationship("Meal")
+    amount = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Integer)
+    comment = db.Column(db.String(50), nullable=False)
+    state_id = db.Column(db.Integer, db.ForeignKey('state.id'))
+    state = db.relationship("State")
+    paid_at = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp(), index=True)
+
+ARCHIVED_COLUMNS = ('id', 'table_id', 'meal_id', 'amount', 'price', 'comment', 'state_id')
+
+def archiveOrders(session, *criterion):
+    ''' move paid orders matching criterion into order_history, returns their ids '''
+    ids = [row.id for row in session.query(Order.id).filter(Order.state_id == 4, *criterion)]
+    if ids:
+        paid = session.query(*[getattr(Order, name) for name in ARCHIVED_COLUMNS]).filter(Order.id.in_(ids))
+        session.execute(OrderHistory.__table__.insert().from_select(ARCHIVED_COLUMNS, paid.statement))
+        session.query(Order).filter(Order.id.in_(ids)).delete(synchronize_session=False)
+    return ids
+
+#### Sales rollups ####
+class MealSales(db.Model):
+    ''' Per day and meal: amount ordered (cancellations subtracted), amount paid and revenue '''
+    __tablename__='sales_meal'
 
-db.create_all()
+    day = db.Column(db.Date, primary_key=True)
+    meal_id = db.Column(db.Integer, primary_key=True)
+    ordered = db.Column(db.Integer, nullable=False, server_default='0')
+    paid = db.Column(db.Integer, nullable=False, server_default='0')
+    revenue = db.Column(db.Integer, nullable=False, server_default='0')
+
+class TableSales(db.Model):
+    ''' Per day and table, the same totals as MealSales '''
+    __tablename__='sales_table'
+
+    day = db.Column(db.Date, primary_key=True)
+    table_id = db.Column(db.Integer, primary_key=True)
+    ordered = db.Column(db.Integer, nullable=False, server_default='0')
+    paid = db.Column(db.Integer, nullable=False, server_default='0')
+    revenue = db.Column(db.Integer, nullable=False, server_default='0')
+
+def addTotals(session, model, key, deltas):
+    ''' add deltas to the row of model at key, inserting it if there is none '''
+    table = model.__table__
+    where = and_(*[table.c[name] == value for name, value in key.items()])
+    values = dict((name, table.c[name] + delta) for name, delta in deltas.items())
+    if not session.execute(table.update().where(where).values(values)).rowcount:
+        session.execute(table.insert().values(dict(key, **deltas)))
+
+def recordSales(session, table_id, meal_id, ordered=0, paid=0, revenue=0):
+    ''' add to today's rollups in the caller's transaction. Days are local dates, as the backfill of migrate() '''
+    deltas = dict(ordered=ordered, paid=paid, revenue=revenue)
+    today = date.today()
+    addTotals(session, MealSales, dict(day=today, meal_id=meal_id), deltas)
+    addTotals(session, TableSales, dict(day=today, table_id=table_id), deltas)
+
+#### Bills ####
+class TableBill(db.Model):
+    ''' Running total of the open (unpaid) orders of a table '''
+    __tablename__='table_bill'
+
+    table_id = db.Column(db.Integer, primary_key=True)
+    total = db.Column(db.Integer, nullable=False, server_default='0')
+
+def addToBill(session, table_id, total):
+    addTotals(session, TableBill, dict(table_id=table_id), dict(total=total))
+
+#### Journal ####
+class OrderEvent(db.Model):
+    ''' Append-only journal of the orders, never updated or deleted: created (with the order), cancelled,
+        advanced (to state_id), paid and cleared (every order, by init()) '''
+    __tablename__ = 'order_event'
+    __table_args__ = {'schema': 'journal', 'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    kind = db.Column(db.String(10), nullable=False)
+    order_id = db.Column(db.Integer)
+    table_id = db.Column(db.Integer)
+    meal_id = db.Column(db.Integer)
+    amount = db.Column(db.Integer)
+    price = db.Column(db.Integer)
+    comment = db.Column(db.String(50))
+    state_id = db.Column(db.Integer)
+
+class OrderSnapshot(db.Model):
+    ''' The open orders once the journal got to event_id, as a JSON list '''
+    __tablename__ = 'order_snapshot'
+    __table_args__ = {'schema': 'journal'}
+
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer, nullable=False, index=True)
+    at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    orders = db.Column(db.Text, nullable=False)
+
+SNAPSHOT_COLUMNS = ARCHIVED_COLUMNS + ('created_at',)
+
+def createdEvent(order):
+    return dict(order_id=order.id, table_id=order.table_id, meal_id=order.meal_id, amount=order.amount,
+                price=order.price, comment=order.comment)
+
+def journal(session, kind, *events):
+    ''' append events, dicts of OrderEvent columns, of kind in the caller's transaction
+        and snapshot the open orders once JOURNAL_SNAPSHOT_EVERY events are past the last snapshot '''
+    session.execute(OrderEvent.__table__.insert(), [dict(event, kind=kind) for event in events or [{}]])
+    last, covered = session.query(func.max(OrderEvent.id),
+                                  session.query(func.max(OrderSnapshot.event_id)).as_scalar()).one()
+    if last - (covered or 0) >= app.config['JOURNAL_SNAPSHOT_EVERY']:
+        snapshot(session, last)
+
+def snapshot(session, event_id):
+    orders = [dict(zip(SNAPSHOT_COLUMNS, row[:-1] + (row[-1].isoformat() if row[-1] else None,)))
+              for row in session.query(*[getattr(Order, name) for name in SNAPSHOT_COLUMNS]).order_by(Order.id)]
+    session.add(OrderSnapshot(event_id=event_id, orders=json.dumps(orders, ensure_ascii=False, separators=(',', ':'))))
+    session.flush()
+    old = [snapshot_id for snapshot_id, in session.query(OrderSnapshot.id).filter(OrderSnapshot.event_id > 0
+           ).order_by(OrderSnapshot.id.desc()).offset(app.config['JOURNAL_SNAPSHOTS_KEPT'])] # 0 is kept for --full
+    if old:
+        session.query(OrderSnapshot).filter(OrderSnapshot.id.in_(old)).delete(synchronize_session=False)
+
+
+def migrate():
+    ''' bring a test.db made by an older pay.py up to the models '''
+    # older versions could draw one code twice, the later tables get a new one before the index
+    duplicated = db.session.query(Table.code).group_by(Table.code).having(db.func.count() > 1)
+    kept = set()
+    for table in db.session.query(Table).filter(Table.code.in_(duplicated)).order_by(Table.id).all():
+        if table.code in kept:
+            table.code = table.newCode()
+        else:
+            kept.add(table.code)
+    db.session.commit()
+    db.engine.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_table_code ON "table" (code)')
+    if 'AUTOINCREMENT' not in db.engine.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'order'").scalar().upper():
+        with db.engine.begin() as connection:
+            connection.execute('ALTER TABLE "order" RENAME TO order_old')
+            Order.__table__.create(connection)
+            connection.execute('INSERT INTO "order" (id, table_id, meal_id, amount, comment, state_id) '
+                               'SELECT id, table_id, meal_id, amount, comment, state_id FROM order_old')
+            connection.execute('DROP TABLE order_old')
+    db.engine.execute('CREATE INDEX IF NOT EXISTS ix_order_table_id ON "order" (table_id)')
+    if 'created_at' not in [column[1] for column in db.engine.execute('PRAGMA table_info("order")')]:
+        db.engine.execute('ALTER TABLE "order" ADD COLUMN created_at DATETIME')
+    for name in ('order', 'order_history'):
+        if 'price' not in [column[1] for column in db.engine.execute('PRAGMA table_info("%s")' % name)]:
+            db.engine.execute('ALTER TABLE "%s" ADD COLUMN price INTEGER' % name)
+        db.engine.execute('UPDATE "%s" SET price = (SELECT price FROM meal WHERE meal.id = meal_id) '
+                          'WHERE price IS NULL' % name)
+    archiveOrders(db.session) # paid orders left by older versions
+    if not db.session.query(MealSales).first():
+        for model, key in ((MealSales, 'meal_id'), (TableSales, 'table_id')):
+            db.session.execute(
+                'INSERT INTO %s (day, %s, ordered, paid, revenue) '
+                "SELECT date(paid_at, 'localtime'), %s, sum(amount), sum(amount), coalesce(sum(amount * price), 0) "
+                'FROM order_history GROUP BY 1, 2' % (model.__tablename__, key, key))
+    if not db.session.query(OrderSnapshot.id).first() and not db.session.query(OrderEvent.id).first():
+        snapshot(db.session, 0) # the open orders from before the journal
+    if not db.session.query(TableBill).first():
+        db.session.execute('INSERT INTO table_bill (table_id, total) '
+                           'SELECT table_id, coalesce(sum(amount * price), 0) FROM "order" GROUP BY table_id')
+    db.session.commit()
+    db.session.remove()
+
+def setupDatabase():
+    ''' create the tables of the current store and migrate, once. main.py runs it for the default store
+        after the port is open, a request coming earlier runs it itself or waits for it '''
+    current = store()
+    with current.schema_lock:
+        if not current.schema_ready.is_set():
+            db.create_all()
+            migrate()
+            current.schema_ready.set()
+
+@app.before_request
+def databaseReady():
+    if not store().schema_ready.is_set():
+        setupDatabase()
+
+#### Writes ####
+def write(job):
+    ''' run job(session) in a transaction and return its result, on the single writer of the store when it is enabled.
+        Objects of the request session belong to another thread there, so jobs load by id and return plain values. '''
+    if store().writer:
+        return store().writer.submit(job)
+    try:
+        result = job(db.session)
+        db.session.commit()
+        return result
+    except:
+        db.session.rollback()
+        raise
+
+@app.errorhandler(writer.Timeout)
+def writerTimeout(error):
+    if error.started: # it may still commit, so no invitation to send it again
+        return jsonify({"msg": "處理逾時，請重新整理確認結果"}), 504
+    response = jsonify({"msg": "系統忙碌中，請稍後再試"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['ADMISSION_RETRY_AFTER'])
+    return response
 
 #### Serialize Model ####
 class MealSchema(Schema):
@@ -147,13 +496,287 @@ class OrderSchema(Schema):
     def getMealName(self, order):
         return order.meal.name
     def getMealPrice(self, order):
-        return order.meal.price
+        return order.price
     def getOrderState(self, order):
         return order.state.name
     class Meta:
         fields = ('id', 'table_id', 'amount', 'comment', 'table_description', 'meal_name', 'meal_price', 'state_name', 'state_id')
 
 orders_schema = OrderSchema(many=True)
+app_metrics.timeSchema('meals_schema', meals_schema)
+app_metrics.timeSchema('tables_schema', tables_schema)
+app_metrics.timeSchema('orders_schema', orders_schema)
+
+# the same JSON straight from row tuples, for the list endpoints
+ORDER_ROWS = rowjson.RowEncoder(id=(0, int), table_id=(1, int), amount=(2, int), comment=(3, str),
+        table_description=(4, str), meal_name=(5, str), meal_price=(6, int), state_name=(7, str), state_id=(8, int))
+MEAL_ROWS = rowjson.RowEncoder(id=(0, int), name=(1, str), price=(2, int), _url=(0, 'meal'))
+TABLE_ROWS = rowjson.RowEncoder(id=(0, int), description=(1, str), url=(0, 'qr'), orderUrl=(2, 'order'))
+
+def urlPrefix(endpoint, **values):
+    ''' url_for(endpoint, **values) without its last path segment, the url of any id is this plus the id '''
+    return url_for(endpoint, **values).rsplit('/', 1)[0] + '/'
+
+#### Queries ####
+def listOrders(*criterion, after_id=None, limit=None):
+    ''' Orders with table, meal and state loaded in one joined SELECT, a page of them after after_id if limit is given '''
+    query = db.session.query(Order).options(
+            joinedload(Order.table), joinedload(Order.meal), joinedload(Order.state)
+        ).filter(*criterion)
+    if after_id is not None:
+        query = query.filter(Order.id > after_id)
+    return query.order_by(Order.id).limit(limit).all()
+
+def orderRows(*criterion, after_id=None, limit=None):
+    ''' listOrders() as the row tuples ORDER_ROWS encodes '''
+    query = db.session.query(Order.id, Order.table_id, Order.amount, Order.comment, Table.description, Meal.name,
+            Order.price, State.name, Order.state_id).outerjoin(Order.table).outerjoin(Order.meal).outerjoin(Order.state
+        ).filter(*criterion)
+    if after_id is not None:
+        query = query.filter(Order.id > after_id)
+    return query.order_by(Order.id).limit(limit).all()
+
+def kitchenMeals():
+    ''' open orders (states 1 and 2) by meal, oldest first: amounts per state, the oldest order and the tables
+        waiting for it, from one GROUP BY. max_id is the newest order counted, for kitchen() PUT '''
+    rows = db.session.query(Order.meal_id, Meal.name, Order.table_id, Table.description, Order.state_id,
+            func.sum(Order.amount), func.count(Order.id), func.min(Order.created_at), func.max(Order.id)
+        ).outerjoin(Order.meal).outerjoin(Order.table).filter(Order.state_id < 3).group_by(
+            Order.meal_id, Meal.name, Order.table_id, Table.description, Order.state_id)
+    meals = {}
+    for meal_id, meal_name, table_id, description, state_id, amount, count, oldest, max_id in rows:
+        meal = meals.get(meal_id)
+        if meal is None:
+            meal = meals[meal_id] = {'meal_id': meal_id, 'meal_name': meal_name, 'amount': 0, 'ordered': 0,
+                                     'preparing': 0, 'orders': 0, 'oldest': None, 'max_id': 0, 'tables': {}}
+        state = 'ordered' if state_id == 1 else 'preparing'
+        meal['amount'] += amount
+        meal[state] += amount
+        meal['orders'] += count
+        meal['max_id'] = max(meal['max_id'], max_id)
+        if oldest and (meal['oldest'] is None or oldest < meal['oldest']):
+            meal['oldest'] = oldest
+        table = meal['tables'].setdefault(table_id, {'table_id': table_id, 'table_description': description,
+                                                     'ordered': 0, 'preparing': 0})
+        table[state] += amount
+    now = datetime.utcnow()
+    result = sorted(meals.values(), key=lambda meal: (meal['oldest'] is None, meal['oldest'] or now, meal['meal_id']))
+    for meal in result:
+        meal['waiting'] = int((now - meal['oldest']).total_seconds()) if meal['oldest'] else None
+        meal['oldest'] = meal['oldest'].isoformat() if meal['oldest'] else None
+        meal['tables'] = sorted(meal['tables'].values(), key=lambda table: table['table_id'])
+    return result
+
+MAX_PAGE = 500
+
+def pagedOrders(msg, *criterion):
+    ''' JSON of the orders matching criterion, paged by the ?after_id=&limit= arguments '''
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE))
+    orders = orderRows(*criterion, after_id=after_id, limit=limit)
+    if not orders and after_id is None: return jsonify({"msg": msg}), 404
+    next_after_id = orders[-1][0] if limit and len(orders) == limit else None
+    with app_metrics.phase('serialize', 'order_rows'):
+        body = '{"next_after_id":%s,"orders":%s}\n' % (rowjson.integer(next_after_id), ORDER_ROWS.encode(orders))
+    return Response(body, mimetype='application/json')
+
+#### Menu cache ####
+class MenuCache(object):
+    ''' Body and ETag of GET /meals/, rebuilt once the menu version is bumped.
+        The entry also expires after ttl seconds, so forked workers pick up edits made by another one. '''
+    def __init__(self, ttl=60):
+        self.version = 0
+        self._ttl = ttl
+        self._entry = None # (version, expire, etag, body), body is None for an empty menu
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+            self._entry = None
+
+    def get(self, build):
+        entry = self._entry
+        if entry and entry[0] == self.version and entry[1] > time.time():
+            return entry
+        with self._lock:
+            version = self.version
+            body = build()
+            etag = hashlib.sha1(body or b'').hexdigest()[:20]
+            entry = (version, time.time() + self._ttl, etag, body)
+            if version == self.version:
+                self._entry = entry
+        return entry
+
+menu_cache = LocalProxy(lambda: store().menu_cache)
+
+def menuBody():
+    meals = db.session.query(Meal.id, Meal.name, Meal.price).all()
+    if not meals: return None
+    with app_metrics.phase('serialize', 'meal_rows'):
+        return ('{"meals":%s}\n' % MEAL_ROWS.encode(meals, meal=urlPrefix('.meals', meals_id=0))).encode('ascii')
+
+#### Table code cache ####
+# code -> (expire, (table id, description)), cleared when qr() POST changes a table. Entries also expire
+# after TABLE_CODE_TTL seconds, so forked workers pick up descriptions changed by another one
+table_codes = LocalProxy(lambda: store().table_codes)
+TABLE_CODE_TTL = 60
+
+def findTable(code):
+    entry = table_codes.get(code)
+    if entry is None or entry[0] <= time.time():
+        table = db.session.query(Table.id, Table.description).filter(Table.code == code).first()
+        if table is None: return None # unknown codes are not cached
+        entry = table_codes[code] = (time.time() + TABLE_CODE_TTL, (table.id, table.description))
+    return entry[1]
+
+#### Stores ####
+class Store(object):
+    ''' The database, QR codes and caches of one restaurant. The default store, name None, keeps them
+        where the app config says, the others in their own directory. '''
+    def __init__(self, name, directory):
+        self.name = name
+        self.uri = 'sqlite:///' + os.path.join(directory, 'test.db') if name else None
+        self.init_lock = os.path.join(directory, 'init.lck') if name else 'init.lck'
+        self.qr_cache = qrcache.QRCache(os.path.join(directory, 'qr') if name else app.config['QR_DIRECTORY'])
+        self.menu_cache = MenuCache()
+        self.table_codes = {}
+        self.writer = writer.Writer(app, db, context=lambda: app_stores.using(self),
+                                    timeout=app.config['SQLITE_WRITER_TIMEOUT']) \
+            if app.config['SQLITE_SINGLE_WRITER'] else None
+        self.schema_ready = threading.Event()
+        self.schema_lock = threading.Lock()
+        self._engine = None
+        self._lock = threading.Lock()
+
+    def engine(self):
+        with self._lock:
+            if self._engine is None:
+                self._engine = db.createEngine(app, self.uri)
+            return self._engine
+
+    def close(self):
+        if self.writer: self.writer.stop()
+        self.qr_cache.close()
+        if self._engine: self._engine.dispose()
+
+app_stores = stores.Stores(Store, os.path.join(app.root_path, app.config['STORES_DIRECTORY']),
+        app.config['STORE_PREFIX'], app.config['STORE_HOSTS'], app.config['STORE_DOMAIN'],
+        app.config['STORE_IDLE'], app.config['STORE_LIMIT'])
+app.wsgi_app = app_stores.middleware(app.wsgi_app)
+store = app_stores.current
+qr_cache = LocalProxy(lambda: store().qr_cache)
+schema_ready = LocalProxy(lambda: store().schema_ready)
+
+def serverHost():
+    ''' host of the order urls: the one the store is served on, SERVER_IP for a url prefix or the default store '''
+    return request.environ.get('pay.store_host') or SERVER_IP
+
+#### Order Input ####
+MAX_AMOUNT = 20
+
+def orderItems():
+    ''' [(meal_id, amount, comment)] of the order form, or of a JSON body
+        {"meals": [{"id": 1, "amount": 2, "comment": ""}]}, raise ValueError if any is invalid '''
+    if request.mimetype == 'application/json':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('meals', []), list):
+            raise ValueError("資料不正確")
+        items = []
+        for meal in data.get('meals', []):
+            if not isinstance(meal, dict):
+                raise ValueError("資料不正確")
+            items.append((meal.get('id'), meal.get('amount', 1), meal.get('comment', '')))
+    else:
+        items = [(meal_id, request.form.get('amount' + meal_id, 1), request.form.get('comment' + meal_id, ''))
+                 for meal_id in request.form.getlist('meals')]
+    result = []
+    for meal_id, amount, comment in items:
+        try:
+            meal_id, amount = int(meal_id), int(amount)
+        except (TypeError, ValueError):
+            raise ValueError("資料不正確")
+        if not 0 < amount <= MAX_AMOUNT:
+            raise ValueError("數量不正確")
+        comment = comment or ''
+        if not isinstance(comment, str) or len(comment) > 50:
+            raise ValueError("附註不正確")
+        result.append((meal_id, amount, comment))
+    return result
+
+#### Menu Input ####
+MAX_MENU_ROWS = 500 # rows of one import, all kept for the single transaction
+MAX_MENU_ITEM = 4096 # characters of one JSON row, more than any meal needs
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*$') # what may still follow the text of a number decoded so far
+
+def jsonArray(stream, size=8192):
+    ''' the items of the JSON array in stream, decoded as each chunk arrives. Items are separated by
+        exactly one comma, and only whitespace may follow the closing bracket '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer, expect, ended = '', '[', False # expect: '[', 'first' item or ']', 'item', ',' or ']', 'end'
+    while not ended:
+        chunk = stream.read(size)
+        ended = not chunk
+        buffer += text.decode(chunk, final=ended)
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer: break
+            if expect == '[':
+                if buffer[0] != '[': raise ValueError("資料不正確")
+                buffer, expect = buffer[1:], 'first'
+            elif expect == ',':
+                if buffer[0] not in ',]': raise ValueError("資料不正確")
+                buffer, expect = buffer[1:], 'item' if buffer[0] == ',' else 'end'
+            elif expect == 'first' and buffer[0] == ']':
+                buffer, expect = buffer[1:], 'end'
+            elif expect in ('first', 'item'):
+                if buffer[0] in ',]': raise ValueError("資料不正確")
+                try:
+                    item, end = decoder.raw_decode(buffer)
+                except ValueError: # not all here yet
+                    if ended: raise ValueError("資料不正確")
+                    break
+                if not ended and isinstance(item, (int, float)) and not isinstance(item, bool) \
+                        and NUMBER_TAIL.match(buffer, end): # 1 of 1.5e3, the rest may be in the next chunk
+                    break
+                if end > MAX_MENU_ITEM: raise ValueError("資料不正確")
+                yield item
+                buffer, expect = buffer[end:], ','
+            else: # anything after the array
+                raise ValueError("資料不正確")
+        if len(buffer) > MAX_MENU_ITEM: # an item still incomplete, too big for a meal
+            raise ValueError("資料不正確")
+    if expect != 'end':
+        raise ValueError("資料不正確")
+
+def menuRows():
+    ''' (row number, dict) of the CSV (id,name,price with a header line) or JSON array request body '''
+    if request.mimetype == 'application/json':
+        return enumerate(jsonArray(request.stream), 1)
+    lines = (line.decode('utf-8-sig') for line in request.stream)
+    return enumerate(csv.DictReader(lines), 1)
+
+def menuItem(row):
+    ''' (id or None, name, price) of a menu row, raise ValueError if it is invalid '''
+    if not isinstance(row, dict):
+        raise ValueError("資料不正確")
+    meal_id, name, price = row.get('id'), row.get('name'), row.get('price')
+    if isinstance(price, (bool, float)) or isinstance(meal_id, (bool, float)):
+        raise ValueError("資料不正確")
+    try:
+        meal_id = int(meal_id) if meal_id not in (None, '') else None
+        price = int(price)
+    except (TypeError, ValueError):
+        raise ValueError("資料不正確")
+    name = name.strip() if isinstance(name, str) else ''
+    if not name or len(name) > 50:
+        raise ValueError("名稱不正確")
+    if price < 0:
+        raise ValueError("價格不正確")
+    return meal_id, name, price
 
 #### Controls ####
 @app.route('/')
@@ -165,26 +788,31 @@ def index():
 def qr( qr_id=None ):
     if qr_id:
         if request.method == "GET":
-            width = request.args.get('width', '800')
-            height = request.args.get('height', '600')
             table = db.session.query(Table).filter(Table.id == qr_id).first()
             if table is None:
                 return jsonify({'msg': 'None'}), 404
-            svg = render_template( str(qr_id) + '.svg', width=width, height=height)
+            try:
+                svg = qrcache.sized(qr_cache.get(table.id, table.orderUrl()),
+                        request.args.get('width'), request.args.get('height'))
+            except ValueError:
+                return jsonify({'msg': '尺寸不正確'}), 400
             response = make_response(svg)
             response.content_type = 'image/svg+xml'
-            return response
+            response.set_etag(hashlib.sha1(svg).hexdigest()[:20])
+            response.cache_control.public = True
+            response.cache_control.max_age = 3600
+            return response.make_conditional(request)
         if request.method == "POST":
-            if qr_id > 20 : qr_id =20
+            if qr_id > app.config['MAX_TABLES'] : qr_id = app.config['MAX_TABLES']
             total = db.session.query(Table).count()
-            import pyqrcode
+            tables = []
             for i in range( qr_id - total ):
-                table = Table( str( total + i + 1)  )
-                db.session.add(table)            
-                qr = pyqrcode.create( table.orderUrl())
-                qr.svg('templates/' + str( total + i + 1) + '.svg', scale=8)
-            else:
+                tables.append(Table( str( total + i + 1)))
+                db.session.add(tables[-1]) # pending, so the next Table() does not draw the same code
+            if tables:
                 db.session.commit()
+                for table in tables: # rendered by the pool, GET waits only if it is not done yet
+                    qr_cache.submit(table.id, table.orderUrl())
             table = db.session.query(Table).filter(Table.id == qr_id).first()
             form = TableDescriptionForm(request.form)
             form.validate() 
@@ -192,70 +820,173 @@ def qr( qr_id=None ):
             form.populate_obj( table)
             db.session.add(table)
             db.session.commit()
+            table_codes.clear()
     if request.is_xhr:
-        tables = db.session.query(Table)
-        result = tables_schema.dump(tables)
-        return jsonify({'tables': result.data})
-    return render_template('QRs.html', form=TableDescriptionForm(), title='QR') 
+        tables = db.session.query(Table.id, Table.description, Table.code).all()
+        with app_metrics.phase('serialize', 'table_rows'):
+            body = '{"tables":%s}\n' % TABLE_ROWS.encode(tables, qr=urlPrefix('.qr', qr_id=0),
+                                                          order='http://' + serverHost() + urlPrefix('.orders', orders_code='-'))
+        return Response(body, mimetype='application/json')
+    return render_template('QRs.html', form=TableDescriptionForm(), title='QR',
+                           max_tables=app.config['MAX_TABLES'])
+
+@app.route("/QR/sheet", methods=["GET"])
+def qrSheet():
+    ''' printable page of every table QR, streamed while the codes are rendered '''
+    size = request.args.get('size', '240')
+    if not size.isdigit():
+        return jsonify({'msg': '尺寸不正確'}), 400
+    tables = [(table.id, table.description, table.orderUrl()) for table in db.session.query(Table).order_by(Table.id)]
+    futures = [qr_cache.submit(table_id, url) for table_id, description, url in tables]
+    def cards():
+        for (table_id, description, url), future in zip(tables, futures):
+            svg = qrcache.sized(future.result(), size, size).decode('utf-8')
+            yield table_id, description, url, Markup(svg)
+    template = app.jinja_env.get_template('QRsheet.html')
+    return Response(stream_with_context(template.generate(title='QR', tables=cards())))
 
 @app.route("/delivery/", methods=["GET"])
 @app.route("/delivery/<int:order_id>", methods=["GET", "PUT", "DELETE"])
 def delivery( order_id=None ):
     if request.is_xhr:
         if request.method == 'PUT':
-            order = db.session.query(Order).filter(Order.id == order_id).first()
-            if order: 
-                order.state_id += 1
-                db.session.add(order)
-                db.session.commit()
-                return jsonify({"msg":"訂單狀態更新為" + order.state.name})
-            return jsonify({"msg": "訂單不存在"}), 404
+            # compare-and-set on the state the screen saw, two screens clicking together advance once
+            expected = request.values.get('state_id', type=int)
+            def advance(session):
+                current = expected
+                if current is None:
+                    current = session.query(Order.state_id).filter(Order.id == order_id).scalar()
+                updated = session.query(Order).filter(Order.id == order_id, Order.state_id == current,
+                        Order.state_id < 3).update({Order.state_id: Order.state_id + 1}, synchronize_session=False)
+                if updated:
+                    journal(session, 'advanced', dict(order_id=order_id, state_id=current + 1))
+                return updated
+            updated = write(advance)
+            orders = listOrders(Order.id == order_id)
+            if not orders:
+                return jsonify({"msg": "訂單不存在", "updated": 0}), 404
+            if not updated:
+                return jsonify({"msg": "訂單狀態已變更為" + orders[0].state.name, "updated": 0,
+                                "state_id": orders[0].state_id}), 409
+            notifyKitchen('state-changed', orders)
+            return jsonify({"msg":"訂單狀態更新為" + orders[0].state.name, "updated": updated})
         if request.method =='DELETE':
-            orders = db.session.query(Order).filter(Order.table_id == order_id)
-            for order in orders:
-                if order.state_id < 3:return jsonify({"msg":"有餐點尚未出餐"}), 405
-                order.state_id = 4    
-                db.session.add(order)
-            else:
-                db.session.commit()
-            return jsonify({"msg":"結帳成功"})
+            def checkout(session):
+                # one UPDATE, guarded so nothing is paid while any order of the table is unserved
+                unserved = aliased(Order)
+                paid = session.query(Order).filter(Order.table_id == order_id, Order.state_id == 3,
+                        ~session.query(unserved.id).filter(unserved.table_id == order_id, unserved.state_id < 3).exists()
+                    ).update({Order.state_id: 4}, synchronize_session=False)
+                if paid:
+                    for meal_id, amount, revenue in session.query(Order.meal_id, func.sum(Order.amount),
+                            func.coalesce(func.sum(Order.amount * Order.price), 0)).filter( # NULL price, meal deleted
+                            Order.table_id == order_id, Order.state_id == 4).group_by(Order.meal_id):
+                        recordSales(session, order_id, meal_id, paid=amount, revenue=revenue)
+                        addToBill(session, order_id, -revenue)
+                    archived = archiveOrders(session, Order.table_id == order_id)
+                    journal(session, 'paid', *[dict(order_id=paid_id) for paid_id in archived])
+                    return paid, archived, 0
+                return 0, [], session.query(Order).filter(Order.table_id == order_id, Order.state_id < 3).count()
+            paid, archived, unserved = write(checkout)
+            if unserved: return jsonify({"msg":"有餐點尚未出餐", "updated": 0}), 405
+            if not paid: return jsonify({"msg":"沒有待結帳的訂單", "updated": 0}), 409
+            if pushEvent: pushEvent('checked-out', {'orders': [{'id': id, 'table_id': order_id} for id in archived]})
+            return jsonify({"msg":"結帳成功", "updated": paid})
         if order_id: # GET xhr with table_id
-            orders = db.session.query(Order).filter(Order.table_id == order_id)
-        else:
-            orders = db.session.query(Order).filter(Order.state_id < 3)
-        if orders.count() == 0: return jsonify({"msg":"沒有訂單"}), 404
-        result = orders_schema.dump(orders)
-        return jsonify({'orders': result.data})
+            return pagedOrders("沒有訂單", Order.table_id == order_id)
+        return pagedOrders("沒有訂單", Order.state_id < 3)
     return render_template('delivery.html', title='Delivery', table_num = db.session.query(Table).count())
             
+@app.route("/kitchen/", methods=["GET"])
+@app.route("/kitchen/<int:meal_id>", methods=["PUT"])
+def kitchen( meal_id=None ):
+    ''' open orders added up by meal, PUT advances every open order of a meal at once:
+        those in state_id if it is given, and up to max_id, the newest order the screen has seen '''
+    if request.is_xhr:
+        if request.method == 'PUT':
+            state_id = request.values.get('state_id', type=int)
+            max_id = request.values.get('max_id', type=int)
+            def advance(session):
+                criterion = [Order.meal_id == meal_id, Order.state_id < 3]
+                if state_id is not None:
+                    criterion.append(Order.state_id == state_id)
+                if max_id is not None:
+                    criterion.append(Order.id <= max_id)
+                # the SELECT takes no lock: each order is advanced by a compare-and-set on the state it was seen
+                # in, so an order another screen moved meanwhile is left alone and not journaled
+                advanced = []
+                for order_id, seen in session.query(Order.id, Order.state_id).filter(*criterion).order_by(Order.id):
+                    if session.query(Order).filter(Order.id == order_id, Order.state_id == seen).update(
+                            {Order.state_id: seen + 1}, synchronize_session=False):
+                        advanced.append((order_id, seen + 1))
+                if advanced:
+                    journal(session, 'advanced', *[dict(order_id=order_id, state_id=state) for order_id, state in advanced])
+                return [order_id for order_id, state in advanced]
+            ids = write(advance)
+            if not ids:
+                return jsonify({"msg": "沒有可更新的訂單", "updated": 0}), 409
+            notifyKitchen('state-changed', listOrders(Order.id.in_(ids)))
+            return jsonify({"msg": "訂單狀態已更新", "updated": len(ids), "orders": ids})
+        meals = kitchenMeals()
+        if not meals: return jsonify({"msg": "沒有待製作的餐點"}), 404
+        return jsonify({'meals': meals})
+    return render_template('kitchen.html', title='Kitchen')
+
 @app.route("/orders/")
 @app.route("/orders/<string:orders_code>", methods=["GET", "POST", "DELETE"])
 def orders(orders_code=None):
-    table = db.session.query(Table).filter(Table.code == orders_code).first()
+    table = findTable(orders_code)
     if table:
+        table_id, table_description = table
         if request.method == 'GET':
             if request.is_xhr:
-                orders = db.session.query(Order).filter(Order.table_id == table.id)
-                if orders.count() == 0 : return jsonify({"msg": "您尚未下訂任何餐點"}), 404
-                result = orders_schema.dump(orders)
-                return jsonify({'orders': result.data})
+                return pagedOrders("您尚未下訂任何餐點", Order.table_id == table_id)
         if request.method == 'POST':
-            for meal_id in request.form.getlist('meals'):
-                meal = db.session.query(Meal).filter(Meal.id == str(meal_id)).first()
-                amount = request.form['amount'+ meal_id]
-                db.session.add( Order(table, meal, amount, request.form['comment' + meal_id]))
-            else:
-                db.session.commit() 
-                lcdShow("!!A new order!! Table " + str(table.id)) 
+            try:
+                items = orderItems()
+            except ValueError as e:
+                return jsonify({"msg": str(e)}), 400
+            meal_ids = set(item[0] for item in items)
+            def submit(session):
+                meals = dict((meal.id, meal) for meal in
+                        session.query(Meal).filter(Meal.id.in_(meal_ids)))
+                if len(meals) != len(meal_ids):
+                    return None
+                table = session.query(Table).get(table_id)
+                new_orders = [Order(table, meals[meal_id], amount, comment)
+                              for meal_id, amount, comment in items]
+                session.add_all(new_orders)
+                session.flush()
+                for meal_id, amount, comment in items:
+                    recordSales(session, table_id, meal_id, ordered=amount)
+                addToBill(session, table_id, sum(order.amount * order.price for order in new_orders))
+                journal(session, 'created', *[createdEvent(order) for order in new_orders])
+                return [order.id for order in new_orders]
+            order_ids = write(submit) if items else []
+            if order_ids is None:
+                return jsonify({"msg": "餐點不存在"}), 400
+            if order_ids:
+                with app_metrics.phase('lcd'):
+                    lcdShow("!!A new order!! Table " + str(table_id))
+                notifyKitchen('order-created', listOrders(Order.id.in_(order_ids)))
+            if request.mimetype == 'application/json':
+                return jsonify({"msg": "點餐成功", "orders": order_ids})
         if request.method == 'DELETE' and request.is_xhr:
-            order_id = request.args.get('order_id')
-            order = db.session.query(Order).filter(Order.id == order_id).first()
-            if order and order.table.id == table.id and order.state_id == 1:
-                db.session.delete(order)
-                db.session.commit()
+            order_id = request.args.get('order_id', type=int)
+            cancelled = orders_schema.dump(listOrders(Order.id == order_id)).data
+            def cancel(session):
+                cancellable = (Order.id == order_id, Order.table_id == table_id, Order.state_id == 1)
+                order = session.query(Order.meal_id, Order.amount, Order.price).filter(*cancellable).first()
+                if order and session.query(Order).filter(*cancellable).delete():
+                    recordSales(session, table_id, order.meal_id, ordered=-order.amount)
+                    addToBill(session, table_id, -order.amount * (order.price or 0))
+                    journal(session, 'cancelled', dict(order_id=order_id))
+                    return True
+            if write(cancel):
+                if pushEvent: pushEvent('order-cancelled', {'orders': cancelled})
                 return jsonify({"msg": "餐點已取消"})
             return jsonify({"msg": "訂單無法取消（已製作）"}), 404
-        return render_template('orders.html', code=orders_code, title="Order", tableDes=table.description)
+        return render_template('orders.html', code=orders_code, title="Order", tableDes=table_description)
     return "<h1>請掃描桌上的QR條碼或輸入正確的網址。</h1>" 
 
 @app.route("/meals/", methods=["GET", "POST"])
@@ -268,51 +999,196 @@ def meals( meals_id=None):
                 if meal is None:
                     return jsonify({"msg":"餐點不存在"}), 404
             return render_template('meal.html', meal=meal, 
-                   form=MealForm(obj=meal), title="Meal::"+meal.name)
+                   form=mealForm(obj=meal), title="Meal::"+meal.name)
         else:
             if request.is_xhr:
-                queryset = db.session.query(Meal)
-                if queryset.count() == 0 : return jsonify({"msg": "本店暫無餐點提供"}), 404
-                result = meals_schema.dump(queryset)
-                return jsonify({'meals': result.data})
+                version, expire, etag, body = menu_cache.get(menuBody)
+                if body is None: return jsonify({"msg": "本店暫無餐點提供"}), 404
+                if etag in request.if_none_match:
+                    response = make_response('', 304)
+                else:
+                    response = make_response(body)
+                    response.content_type = 'application/json'
+                response.set_etag(etag)
+                response.cache_control.no_cache = True
+                return response
     elif request.method == 'POST' and request.is_xhr:
-        form = MealForm(request.form)
+        form = mealForm(request.form)
         if form.validate():
-            meal = Meal( form.name, form.price)
-            form.populate_obj(meal)
-            db.session.add(meal)
-            db.session.commit()
+            def add(session):
+                meal = Meal( form.name, form.price)
+                form.populate_obj(meal)
+                session.add(meal)
+            write(add)
+            menu_cache.bump()
             return jsonify({"msg": "餐點新增成功"})
         return jsonify({"msg": "資料不正確"}), 400
     elif request.method == 'PUT' and request.is_xhr:
         meal = db.session.query(Meal).filter(Meal.id == meals_id).first()
         if meal is None: 
             return jsonify({"msg":"欲修改的餐點不存在（已被刪除）"}), 404
-        form = MealForm(request.form, obj=meal)
+        form = mealForm(request.form, obj=meal)
         if form.validate():
-            meal.name = form.name
-            meal.price = form.price
-            form.populate_obj(meal)
-            db.session.add(meal)
-            db.session.commit()
+            def edit(session):
+                meal = session.query(Meal).get(meals_id)
+                if meal:
+                    form.populate_obj(meal)
+                    return True
+            if not write(edit):
+                return jsonify({"msg":"欲修改的餐點不存在（已被刪除）"}), 404
+            menu_cache.bump()
             return jsonify({"msg":"餐點修改完成"})
         return jsonify({"msg":"資料不正確"}), 400
     elif request.method == 'DELETE' and request.is_xhr :
-        meal = db.session.query(Meal).filter(Meal.id == meals_id).first()
-        if meal:
-            db.session.delete(meal)
-            db.session.commit()
+        def remove(session):
+            return session.query(Meal).filter(Meal.id == meals_id).delete()
+        if write(remove):
+            menu_cache.bump()
             return jsonify({"msg": "餐點成功刪除"})
         return jsonify({"msg":"欲修改的餐點不存在（已被刪除）"}), 404
-    return render_template('meals.html', form=MealForm(), 
+    return render_template('meals.html', form=mealForm(), 
                             title="Meal::List")
 
+@app.route("/meals/bulk", methods=["GET", "POST"])
+def mealsBulk():
+    ''' the whole menu as CSV or JSON (?format=json), POST upserts a menu in one transaction:
+        rows with an id update that meal, rows without one update the meal of the same name or add it '''
+    if request.method == 'POST' and request.is_xhr:
+        items, errors = [], []
+        try:
+            for line, row in menuRows():
+                if line > MAX_MENU_ROWS: return jsonify({"msg": "餐點過多"}), 400
+                try:
+                    items.append(menuItem(row))
+                except ValueError as e:
+                    errors.append({'row': line, 'msg': str(e)})
+        except (ValueError, csv.Error):
+            return jsonify({"msg": "資料不正確"}), 400
+        keys = [meal_id if meal_id is not None else name for meal_id, name, price in items]
+        if len(set(keys)) != len(keys):
+            return jsonify({"msg": "餐點重複"}), 400
+        if errors:
+            return jsonify({"msg": "資料不正確", "errors": errors[:20]}), 400
+        if not items:
+            return jsonify({"msg": "沒有餐點"}), 400
+        def upsert(session):
+            ids = [meal_id for meal_id, name, price in items if meal_id is not None]
+            names = [name for meal_id, name, price in items if meal_id is None]
+            existing = set(meal_id for meal_id, in session.query(Meal.id).filter(Meal.id.in_(ids))) if ids else set()
+            named = dict(session.query(Meal.name, Meal.id).filter(Meal.name.in_(names))) if names else {}
+            updates, inserts, updated = [], [], set()
+            for row, (meal_id, name, price) in enumerate(items, 1):
+                meal_id = named.get(name) if meal_id is None else meal_id
+                if meal_id in existing or meal_id in named.values():
+                    if meal_id in updated: # a row by name for the meal of a row by id, or the other way round
+                        return None, row
+                    updated.add(meal_id)
+                    updates.append(dict(id=meal_id, name=name, price=price))
+                else:
+                    inserts.append(dict(name=name, price=price) if meal_id is None else dict(id=meal_id, name=name, price=price))
+            session.bulk_update_mappings(Meal, updates)
+            session.bulk_insert_mappings(Meal, inserts)
+            return len(inserts), len(updates)
+        inserted, updated = write(upsert)
+        if inserted is None: # nothing was written, updated is the row of the second update of a meal
+            return jsonify({"msg": "餐點重複", "errors": [{'row': updated, 'msg': "餐點重複"}]}), 400
+        menu_cache.bump()
+        return jsonify({"msg": "菜單匯入完成", "inserted": inserted, "updated": updated})
+    if request.method == 'POST':
+        return jsonify({"msg": "資料不正確"}), 400
+    rows = db.session.query(Meal.id, Meal.name, Meal.price).order_by(Meal.id).yield_per(100)
+    if request.args.get('format') == 'json':
+        def items():
+            yield '['
+            for i, (meal_id, name, price) in enumerate(rows):
+                yield (',\n' if i else '\n') + json.dumps({'id': meal_id, 'name': name, 'price': price}, ensure_ascii=False)
+            yield '\n]\n'
+        response = Response(stream_with_context(items()), mimetype='application/json')
+        response.headers['Content-Disposition'] = 'attachment; filename=menu.json'
+        return response
+    response = Response(stream_with_context(csvLines(('id', 'name', 'price'), rows)), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=menu.csv'
+    return response
+
+@app.route("/bill/<int:table_id>", methods=["GET"])
+def bill( table_id ):
+    ''' open orders of a table with the subtotal of its running bill '''
+    orders = orderRows(Order.table_id == table_id)
+    if not orders: return jsonify({"msg": "沒有待結帳的訂單"}), 404
+    total = db.session.query(TableBill.total).filter(TableBill.table_id == table_id).scalar()
+    with app_metrics.phase('serialize', 'order_rows'):
+        body = '{"orders":%s,"subtotal":%d,"table_id":%d}\n' % (ORDER_ROWS.encode(orders), total or 0, table_id)
+    return Response(body, mimetype='application/json')
+
+@app.route("/report/", methods=["GET"])
+def report():
+    if request.is_xhr or request.args.get('format') == 'csv':
+        by = request.args.get('by', 'day')
+        try:
+            start, end = [datetime.strptime(request.args[name], '%Y-%m-%d').date() if request.args.get(name) else None
+                          for name in ('from', 'to')]
+        except ValueError:
+            return jsonify({"msg": "日期不正確"}), 400
+        if by not in ('day', 'meal', 'table'):
+            return jsonify({"msg": "資料不正確"}), 400
+        header, rows = salesReport(by, start, end)
+        if request.args.get('format') == 'csv':
+            response = Response(stream_with_context(csvLines(header, rows)), mimetype='text/csv')
+            response.headers['Content-Disposition'] = 'attachment; filename=report-%s.csv' % by
+            return response
+        return jsonify({'report': [dict(zip(header, [value.isoformat() if isinstance(value, date) else value
+                                                    for value in row])) for row in rows]})
+    return render_template('report.html', title='Report')
+
+def salesReport(by, start=None, end=None):
+    ''' (header, rows) of the rollups between start and end, grouped by day, meal or table '''
+    model = TableSales if by == 'table' else MealSales
+    sums = [func.sum(model.ordered), func.sum(model.paid), func.sum(model.revenue)]
+    if by == 'day':
+        header = ('day', 'ordered', 'paid', 'revenue')
+        query = db.session.query(model.day, *sums).group_by(model.day).order_by(model.day)
+    elif by == 'meal':
+        header = ('meal_id', 'meal_name', 'ordered', 'paid', 'revenue')
+        query = db.session.query(model.meal_id, Meal.name, *sums).outerjoin(Meal, Meal.id == model.meal_id
+                ).group_by(model.meal_id, Meal.name).order_by(model.meal_id)
+    else:
+        header = ('table_id', 'table_description', 'ordered', 'paid', 'revenue')
+        query = db.session.query(model.table_id, Table.description, *sums).outerjoin(Table, Table.id == model.table_id
+                ).group_by(model.table_id, Table.description).order_by(model.table_id)
+    if start: query = query.filter(model.day >= start)
+    if end: query = query.filter(model.day <= end)
+    return header, query
+
+def csvLines(header, rows):
+    buffer = io.StringIO()
+    out = csv.writer(buffer)
+    out.writerow(header)
+    for row in rows:
+        out.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route("/metrics")
+def metricsText():
+    return Response(app_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route("/metrics/profile", methods=["GET", "POST"])
+def metricsProfile():
+    ''' POST path=/delivery/ profiles the next request under that path, GET shows the last profile '''
+    if request.method == 'POST':
+        app_metrics.arm(request.values.get('path', '/'))
+        return jsonify({"msg": "下一個請求將被分析"})
+    if app_metrics.profile is None:
+        return jsonify({"msg": "尚無分析結果"}), 404
+    return Response(app_metrics.profile, content_type='text/plain; charset=utf-8')
+
 @app.route("/init/", methods=["GET","PUT", "DELETE"]) 
 def init():
     if request.is_xhr:
         if request.method == 'PUT':
-            import os.path
-            if os.path.isfile('init.lck'):
+            if os.path.isfile(store().init_lock):
                 return jsonify({"msg": "資料庫已存在"})
             dic = {
                     "勁辣雞腿堡" : 50,
@@ -324,6 +1200,7 @@ def init():
                 db.session.add(meal)
             else:
                 db.session.commit()
+                menu_cache.bump()
             db.session.add(Table('第一桌'))
             db.session.add(State('已下訂')) #1
             db.session.add(State('準備中')) #2
@@ -331,24 +1208,28 @@ def init():
             db.session.add(State('已結帳')) #4
             db.session.commit()
             table = db.session.query(Table).first()
-            import pyqrcode
-            qr = pyqrcode.create( table.orderUrl())
-            qr.svg('templates/1.svg', scale=8)
+            qr_cache.submit(table.id, table.orderUrl())
             meal = db.session.query(Meal).first()
-            db.session.add(Order(table, meal, 1, "不要洋蔥"))
+            orders = [Order(table, meal, 1, "不要洋蔥")]
+            recordSales(db.session, table.id, meal.id, ordered=1)
+            addToBill(db.session, table.id, meal.price)
             meal = db.session.query(Meal)[-1]
-            db.session.add(Order(table, meal))
+            orders.append(Order(table, meal))
+            recordSales(db.session, table.id, meal.id, ordered=1)
+            addToBill(db.session, table.id, meal.price)
+            db.session.add_all(orders)
+            db.session.flush()
+            journal(db.session, 'created', *[createdEvent(order) for order in orders])
             db.session.commit()
-            f = open('init.lck', 'w')
+            f = open(store().init_lock, 'w')
             return jsonify({"msg": "餐資料初始化完成"})
         elif request.method == 'DELETE':
             db.session.query(Order).delete()            
+            db.session.query(TableBill).delete()
+            journal(db.session, 'cleared')
             db.session.commit()
             return jsonify({"msg":"訂單清除成功"}) 
-        orders = db.session.query(Order)
-        if orders.count() == 0: return jsonify({"msg":"無訂單"}), 404
-        result = orders_schema.dump(orders)
-        return jsonify({"orders": result.data})
+        return pagedOrders("無訂單")
     return render_template('init.html', title='Database')
         
 
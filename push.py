@@ -0,0 +1,79 @@
+import json
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.web import RequestHandler
+
+class Hub(object):
+    ''' Broadcast kitchen events to the EventHandlers subscribed to a channel, one per store, as Server-Sent
+        Events. publish() may be called from any thread, the writes always happen on the IOLoop.'''
+
+    def __init__(self, keepalive=15):
+        self._clients = {} # channel -> set of clients
+        self._loop = None
+        self._keepalive = keepalive
+
+    def start(self, loop=None):
+        self._loop = loop or IOLoop.current()
+        # a comment line every few seconds drops dead connections and keeps proxies open
+        PeriodicCallback(lambda: self._send(b': keepalive\n\n'), self._keepalive * 1000).start()
+
+    def subscribe(self, client, channel=None):
+        self._clients.setdefault(channel, set()).add(client)
+
+    def unsubscribe(self, client, channel=None):
+        clients = self._clients.get(channel, set())
+        clients.discard(client)
+        if not clients:
+            self._clients.pop(channel, None)
+
+    def publish(self, event, data, channel=None):
+        if self._loop is None:
+            return
+        # encode once, every screen gets the same bytes
+        chunk = ('event: ' + event + '\ndata: ' + json.dumps(data) + '\n\n').encode('utf-8')
+        self._loop.add_callback(self._send, chunk, [channel])
+
+    def _send(self, chunk, channels=None):
+        ''' write chunk to the clients of channels, of all of them if None '''
+        for channel in list(self._clients) if channels is None else channels:
+            for client in list(self._clients.get(channel, ())):
+                client.push(chunk)
+
+hub = Hub()
+
+class EventHandler(RequestHandler):
+    ''' GET /events/ , a text/event-stream kept open until the screen goes away.
+        channel(request) names the channel the screen listens to. '''
+
+    def initialize(self, hub, channel=lambda request: None):
+        self.hub = hub
+        self.channel = channel
+        self._closed = Future()
+
+    @gen.coroutine
+    def get(self):
+        self.set_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('X-Accel-Buffering', 'no')
+        channel = self.channel(self.request)
+        self.hub.subscribe(self, channel)
+        try:
+            self.push(b'retry: 3000\n\n')
+            yield self._closed
+        finally:
+            self.hub.unsubscribe(self, channel)
+
+    def push(self, chunk):
+        if self._closed.done():
+            return
+        self.write(chunk)
+        self.flush().add_done_callback(self._flushed)
+
+    def _flushed(self, future):
+        if future.exception() is not None:
+            self.on_connection_close()
+
+    def on_connection_close(self):
+        if not self._closed.done():
+            self._closed.set_result(None)
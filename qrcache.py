@@ -0,0 +1,75 @@
+import hashlib
+import io
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SIZE = re.compile(br' height="(\d+)" width="(\d+)"')
+
+class QRCache(object):
+    ''' SVG QR codes of the table order urls, rendered once by a worker pool.
+        Each code is kept in memory and in directory/<table id>-<url hash>.svg ,
+        so a changed SERVER_IP renders a new file instead of serving a stale one.'''
+
+    def __init__(self, directory='qr', workers=2, scale=8):
+        self._dir = directory
+        self._scale = scale
+        self._executor = ThreadPoolExecutor(workers)
+        self._svg = {} # table id -> (url, svg bytes)
+        self._pending = {} # (table id, url) -> Future
+        self._lock = threading.Lock()
+
+    def path(self, table_id, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self._dir, '%d-%s.svg' % (table_id, digest))
+
+    def render(self, table_id, url):
+        path = self.path(table_id, url)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                svg = f.read()
+        else:
+            import pyqrcode
+            out = io.BytesIO()
+            pyqrcode.create(url).svg(out, scale=self._scale, xmldecl=False)
+            svg = SIZE.sub(br' viewBox="0 0 \2 \1"\g<0>', out.getvalue(), 1)
+            if not os.path.isdir(self._dir):
+                os.makedirs(self._dir)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(svg)
+            os.rename(path + '.tmp', path)
+        with self._lock:
+            self._svg[table_id] = (url, svg)
+            self._pending.pop((table_id, url), None)
+        return svg
+
+    def submit(self, table_id, url):
+        ''' render in the background, returns a Future of the svg bytes '''
+        with self._lock:
+            future = self._pending.get((table_id, url))
+            if future is None:
+                future = self._executor.submit(self.render, table_id, url)
+                self._pending[(table_id, url)] = future
+        return future
+
+    def get(self, table_id, url):
+        cached = self._svg.get(table_id)
+        if cached and cached[0] == url:
+            return cached[1]
+        return self.submit(table_id, url).result()
+
+    def close(self):
+        ''' let the renders already submitted finish, then end the worker threads '''
+        self._executor.shutdown(wait=False)
+
+def sized(svg, width=None, height=None):
+    ''' the svg with its root width/height replaced, the viewBox keeps it scaled '''
+    if not width and not height:
+        return svg
+    match = SIZE.search(svg)
+    if match is None: # not one of ours, nothing to resize
+        return svg
+    height = str(int(height)).encode() if height else match.group(1)
+    width = str(int(width)).encode() if width else match.group(2)
+    return svg[:match.start()] + b' height="' + height + b'" width="' + width + b'"' + svg[match.end():]
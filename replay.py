@@ -0,0 +1,109 @@
+''' Rebuild the open orders of a database from its journal, the latest snapshot and the events after it
+
+    python replay.py [--db test.db] [--full] [--until EVENT_ID] [--dry-run] [--order ORDER_ID]
+
+The journal is the .events.db next to the database. The order table is replaced by the
+replayed orders and the table bills are rebuilt from them. --full replays the whole journal
+and also restores the paid orders of order_history. Menu, tables and states are not in the
+journal: after losing test.db, replay into a backup of it, or an empty one.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+def replay(orders, events):
+    ''' the open orders (id -> dict) and the paid ones after applying events to orders '''
+    paid = []
+    for event in events:
+        if event.kind == 'created':
+            orders[event.order_id] = dict(id=event.order_id, table_id=event.table_id, meal_id=event.meal_id,
+                                          amount=event.amount, price=event.price, comment=event.comment,
+                                          state_id=1, created_at=event.at)
+        elif event.kind == 'cancelled':
+            orders.pop(event.order_id, None)
+        elif event.kind == 'advanced':
+            if event.order_id in orders:
+                orders[event.order_id]['state_id'] = event.state_id
+        elif event.kind == 'paid':
+            order = orders.pop(event.order_id, None)
+            if order:
+                paid.append(dict(order, state_id=4, paid_at=event.at))
+        elif event.kind == 'cleared':
+            orders.clear()
+    return orders, paid
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--db', default='test.db')
+    parser.add_argument('--full', action='store_true', help='replay the whole journal, not only its tail')
+    parser.add_argument('--until', type=int, help='stop at this event, the orders as they were then')
+    parser.add_argument('--dry-run', action='store_true', help='only print what would be restored')
+    parser.add_argument('--order', type=int, help='print the events of this order and stop')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import pay
+    from pay import db, func, Order, OrderEvent, OrderHistory, OrderSnapshot, TableBill
+    pay.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(args.db)
+    with pay.app.app_context():
+        db.create_all()
+        events = db.session.query(OrderEvent).order_by(OrderEvent.id)
+        if args.order is not None:
+            for event in events.filter(OrderEvent.order_id == args.order):
+                print('%d %s %s %s' % (event.id, event.at.isoformat(' '), event.kind,
+                      ' '.join('%s=%s' % (name, getattr(event, name)) for name in
+                               ('table_id', 'meal_id', 'amount', 'price', 'comment', 'state_id')
+                               if getattr(event, name) is not None)))
+            return 0
+
+        start = time.perf_counter()
+        orders, covered = {}, 0
+        latest = db.session.query(OrderSnapshot).order_by(OrderSnapshot.event_id.desc())
+        if args.full: # the orders from before the journal
+            latest = latest.filter(OrderSnapshot.event_id == 0)
+        if args.until is not None:
+            latest = latest.filter(OrderSnapshot.event_id <= args.until)
+        latest = latest.first()
+        if latest:
+            covered = latest.event_id
+            for order in json.loads(latest.orders):
+                if order['created_at']:
+                    order['created_at'] = datetime.fromisoformat(order['created_at'])
+                orders[order['id']] = order
+        tail = events.filter(OrderEvent.id > covered)
+        if args.until is not None:
+            tail = tail.filter(OrderEvent.id <= args.until)
+        tail = tail.all()
+        orders, paid = replay(orders, tail)
+        print('snapshot of event %d with the events %s: %d open orders, %d paid, in %.1fms'
+              % (covered, '%d to %d' % (tail[0].id, tail[-1].id) if tail else 'none', len(orders), len(paid),
+                 (time.perf_counter() - start) * 1000))
+        if args.dry_run:
+            return 0
+
+        db.session.query(Order).delete()
+        db.session.bulk_insert_mappings(Order, sorted(orders.values(), key=lambda order: order['id']))
+        if paid:
+            db.session.query(OrderHistory).filter(OrderHistory.id.in_([order['id'] for order in paid])).delete(
+                synchronize_session=False)
+            db.session.bulk_insert_mappings(OrderHistory, [dict((name, order[name]) for name in
+                                            pay.ARCHIVED_COLUMNS + ('paid_at',)) for order in paid])
+        db.session.query(TableBill).delete() # migrate() adds the bills up again from the orders
+        # AUTOINCREMENT only remembers the ids of the rows it inserted: keep the journaled and archived
+        # ids taken, or the next order reuses the id of a paid one and checkout fails on order_history
+        used = max(db.session.query(func.max(OrderEvent.order_id)).scalar() or 0,
+                   db.session.query(func.max(OrderHistory.id)).scalar() or 0, max(orders, default=0))
+        if not db.session.execute(db.text("UPDATE sqlite_sequence SET seq = max(seq, :used) WHERE name = 'order'"),
+                                  dict(used=used)).rowcount:
+            db.session.execute(db.text("INSERT INTO sqlite_sequence (name, seq) VALUES ('order', :used)"),
+                               dict(used=used))
+        db.session.commit()
+        db.session.remove()
+        pay.migrate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
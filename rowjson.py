@@ -0,0 +1,36 @@
+from json.encoder import encode_basestring_ascii as quote
+
+def integer(value):
+    return 'null' if value is None else str(value)
+
+def string(value):
+    return 'null' if value is None else quote(value)
+
+class RowEncoder(object):
+    ''' JSON of query row tuples, written as jsonify writes the dicts marshmallow makes of the same rows for
+        an XHR request: sorted keys, compact, ascii. The object layout is compiled once into a % template,
+        fields are key=(column index, int or str), or key=(column index, 'name') for the url prefix given
+        to encode() as name followed by that column.'''
+
+    def __init__(self, **fields):
+        self._template = '{' + ','.join(quote(key).replace('%', '%%') + ':%s' for key in sorted(fields)) + '}'
+        self._columns = [] # (index, encode) in key order
+        self._prefixes = [] # (position in _columns, prefix name)
+        for key in sorted(fields):
+            index, kind = fields[key]
+            if kind is int:
+                self._columns.append((index, integer))
+            elif kind is str:
+                self._columns.append((index, string))
+            else:
+                self._prefixes.append((len(self._columns), kind))
+                self._columns.append((index, None))
+
+    def encode(self, rows, **prefixes):
+        ''' the JSON array of rows, as str '''
+        columns = list(self._columns)
+        for position, name in self._prefixes: # bound once per call instead of a url_for per row
+            columns[position] = (columns[position][0],
+                                 lambda value, prefix=prefixes[name]: string(prefix + str(value)))
+        template = self._template
+        return '[' + ','.join(template % tuple(encode(row[index]) for index, encode in columns) for row in rows) + ']'
@@ -0,0 +1,56 @@
+import mimetypes
+import os
+from tornado.web import StaticFileHandler
+
+IMMUTABLE = 365 * 24 * 3600
+
+def acceptedEncodings(header):
+    ''' content coding -> q value of an Accept-Encoding header, * for the codings it does not name '''
+    weights = {}
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+    return weights
+
+class StaticHandler(StaticFileHandler):
+    ''' StaticFileHandler sending the .br or .gz file built next to the one asked for when the client
+        accepts it, and files under build/, whose names change with their content, as immutable. '''
+
+    def get(self, path, include_body=True):
+        self._path = path
+        self._encoding = None
+        weights = acceptedEncodings(self.request.headers.get('Accept-Encoding', ''))
+        candidates = [(weights.get(encoding, weights.get('*', 0.0)), encoding, suffix)
+                      for encoding, suffix in (('br', '.br'), ('gzip', '.gz'))]
+        # the highest q first, br before gzip when they are equal; q=0 means not acceptable
+        for q, encoding, suffix in sorted(candidates, key=lambda candidate: -candidate[0]):
+            if q > 0 and os.path.isfile(os.path.join(self.root, path + suffix)):
+                self._encoding = encoding
+                path += suffix
+                break
+        return super(StaticHandler, self).get(path, include_body)
+
+    def get_content_type(self):
+        mime_type, encoding = mimetypes.guess_type(self._path)
+        return mime_type or 'application/octet-stream'
+
+    def get_cache_time(self, path, modified, mime_type):
+        return IMMUTABLE if self._path.startswith('build/') else 0
+
+    def set_extra_headers(self, path):
+        self.set_header('Vary', 'Accept-Encoding')
+        if self._encoding:
+            self.set_header('Content-Encoding', self._encoding)
+        if self._path.startswith('build/'):
+            self.set_header('Cache-Control', 'public, max-age=%d, immutable' % IMMUTABLE)
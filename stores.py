@@ -0,0 +1,144 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from flask import has_request_context, request
+from werkzeug.wsgi import ClosingIterator
+
+NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')
+
+class Stores(object):
+    ''' The stores served by one process. Each directory under directory/ is a store, chosen by the
+        host name (hosts, or <name>.domain) or by the url prefix /<prefix>/<name>/ of a request.
+        make(name, path) opens one on its first request, store.close() closes it once it has been idle
+        for idle seconds, or the least recently used idle ones when more than limit are open. A thread
+        looks for idle stores every idle/2 seconds while any store is open, so they are closed even when
+        only the default store gets requests.
+        Requests naming no store go to the default one, make(None, None), which is never closed.'''
+
+    def __init__(self, make, directory='stores', prefix='/store', hosts=None, domain=None, idle=600, limit=32):
+        self._make = make
+        self._directory = directory
+        self._prefix = prefix.rstrip('/')
+        self._hosts = dict(hosts or {})
+        self._domain = domain
+        self._idle = idle
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open = {} # name -> store
+        self._users = {} # name -> requests holding it
+        self._used = {} # name -> time.monotonic() of its last request
+        self._sweeper = None
+        self.default = make(None, None)
+
+    def resolve(self, host, path):
+        ''' (name of the store of a request to host and path or None, the path prefix naming it) '''
+        host = host.split(':')[0].lower()
+        name = self._hosts.get(host)
+        if name is None and self._domain and host.endswith('.' + self._domain):
+            name = host[:-len(self._domain) - 1]
+        if name is not None:
+            return name, ''
+        if path.startswith(self._prefix + '/'):
+            name = path[len(self._prefix) + 1:].split('/', 1)[0]
+            return name, self._prefix + '/' + name
+        return None, ''
+
+    #### Open stores ####
+    def acquire(self, name):
+        ''' the store called name, opened if need be and held until release(), None if there is none '''
+        if name is None:
+            return self.default
+        if not NAME.match(name):
+            return None
+        with self._lock:
+            store = self._open.get(name)
+            if store is None:
+                path = os.path.join(self._directory, name)
+                if not os.path.isdir(path):
+                    return None
+                store = self._open[name] = self._make(name, path)
+                self._users[name] = 0
+                if self._sweeper is None:
+                    self._sweeper = threading.Thread(target=self._sweep, name='stores-sweeper', daemon=True)
+                    self._sweeper.start()
+            self._users[name] += 1
+            self._used[name] = time.monotonic()
+            self._evict()
+        return store
+
+    def release(self, store):
+        if store is self.default:
+            return
+        with self._lock:
+            self._users[store.name] -= 1
+            self._used[store.name] = time.monotonic()
+            self._evict()
+
+    def _evict(self):
+        ''' close the idle stores, oldest first, that are over the idle time or the limit '''
+        now = time.monotonic()
+        idle = sorted((self._used[name], name) for name in self._open if not self._users[name])
+        for used, name in idle:
+            if now - used <= self._idle and len(self._open) <= self._limit:
+                break
+            store = self._open.pop(name)
+            del self._users[name], self._used[name]
+            store.close()
+
+    def _sweep(self):
+        ''' evict every idle/2 seconds until no store is open '''
+        while True:
+            time.sleep(max(1, self._idle / 2))
+            with self._lock:
+                self._evict()
+                if not self._open:
+                    self._sweeper = None
+                    return
+
+    def names(self):
+        with self._lock:
+            return sorted(self._open)
+
+    #### Current store ####
+    def current(self):
+        ''' the store of this request or using() block, the default one otherwise '''
+        store = getattr(self._local, 'store', None)
+        if store is None and has_request_context():
+            store = request.environ.get('pay.store')
+        return store or self.default
+
+    @contextmanager
+    def using(self, store):
+        ''' make store the current one of this thread, for threads working outside of requests '''
+        previous = getattr(self._local, 'store', None)
+        self._local.store = store
+        try:
+            yield store
+        finally:
+            self._local.store = previous
+
+    def middleware(self, wsgi_app):
+        ''' wsgi_app with the store of each request in environ['pay.store'], held while the response is
+            sent. A url prefix naming the store is moved to SCRIPT_NAME, so url_for() keeps it. '''
+        def dispatch(environ, start_response):
+            name, prefix = self.resolve(environ.get('HTTP_HOST', ''), environ.get('PATH_INFO', ''))
+            store = self.acquire(name)
+            if store is None:
+                start_response('404 NOT FOUND', [('Content-Type', 'application/json')])
+                return [json.dumps({"msg": "商店不存在"}).encode('ascii')]
+            if prefix:
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix
+                environ['PATH_INFO'] = environ['PATH_INFO'][len(prefix):]
+            elif name is not None:
+                environ['pay.store_host'] = environ.get('HTTP_HOST')
+            environ['pay.store'] = store
+            try:
+                return ClosingIterator(wsgi_app(environ, start_response), lambda: self.release(store))
+            except:
+                self.release(store)
+                raise
+        return dispatch
@@ -0,0 +1,120 @@
+''' Tests of the menu import: the streaming JSON array parser and POST /meals/bulk
+
+    python -m unittest test_menu
+'''
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import pay
+
+XHR = {'X-Requested-With': 'XMLHttpRequest'}
+
+def items(body, size=8192):
+    return list(pay.jsonArray(io.BytesIO(body), size))
+
+class JSONArrayTest(unittest.TestCase):
+    def assertInvalid(self, body):
+        for size in (1, 2, 3, 8192):
+            with self.assertRaises(ValueError, msg='%r in chunks of %d' % (body, size)):
+                items(body, size)
+
+    def test_items(self):
+        self.assertEqual(items(b'[{"a":1},{"b":2}]'), [{'a': 1}, {'b': 2}])
+        self.assertEqual(items(b' [ 1 ,\n2, "x" ] \n'), [1, 2, 'x'])
+        self.assertEqual(items(b'[]'), [])
+
+    def test_chunk_boundaries(self):
+        body = '[{"name": "紅茶", "price": 20}, 12345, {"name": "太陽蛋"}]'.encode('utf-8')
+        for size in range(1, len(body) + 1):
+            self.assertEqual(items(body, size), [{'name': '紅茶', 'price': 20}, 12345, {'name': '太陽蛋'}], size)
+        body = b'[1.5e3, -2.25, 7E-1, 10, {"price": 1.5e+2}]'
+        for size in range(1, len(body) + 1):
+            self.assertEqual(items(body, size), [1500.0, -2.25, 0.7, 10, {'price': 150.0}], size)
+        self.assertEqual(items(b'[1.5e3]', 1), [1500.0])
+
+    def test_bom(self):
+        for size in (1, 2, 8192):
+            self.assertEqual(items(b'\xef\xbb\xbf[1, 2]', size), [1, 2])
+
+    def test_missing_comma(self):
+        self.assertInvalid(b'[{"a":1} {"b":2}]')
+        self.assertInvalid(b'[1 2]')
+
+    def test_extra_commas(self):
+        self.assertInvalid(b'[,{"a":1}]')
+        self.assertInvalid(b'[,,{"a":1}]')
+        self.assertInvalid(b'[{"a":1},,{"b":2}]')
+        self.assertInvalid(b'[{"a":1},]')
+        self.assertInvalid(b'[,]')
+
+    def test_after_the_array(self):
+        self.assertEqual(items(b'[1]   \n'), [1])
+        self.assertInvalid(b'[1] x')
+        self.assertInvalid(b'[1]]')
+        self.assertInvalid(b'[1][2]')
+
+    def test_not_an_array(self):
+        self.assertInvalid(b'')
+        self.assertInvalid(b'{"a":1}')
+        self.assertInvalid(b'[{"a":1}')
+        self.assertInvalid(b'[{"a":}]')
+
+    def test_oversize_item(self):
+        big = json.dumps({'name': 'x' * pay.MAX_MENU_ITEM}).encode('ascii')
+        self.assertInvalid(b'[' + big + b']')
+        self.assertInvalid(b'[' + big[:-1]) # never completed
+
+class MealsBulkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = dict(pay.app.config)
+        pay.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self.directory, 'test.db')
+        pay.app.config['QR_DIRECTORY'] = os.path.join(self.directory, 'qr')
+        self.default = pay.app_stores.default
+        pay.app_stores.default = pay.Store(None, None)
+        self.client = pay.app.test_client()
+
+    def tearDown(self):
+        pay.app_stores.default.close()
+        pay.app_stores.default = self.default
+        pay.app.config.update(self.config)
+        shutil.rmtree(self.directory)
+
+    def post(self, rows):
+        response = self.client.post('/meals/bulk', data=json.dumps(rows), content_type='application/json',
+                                    headers=XHR)
+        try:
+            return response.status_code, json.loads(response.data.decode('utf-8'))
+        finally:
+            response.close()
+
+    def meals(self):
+        with pay.app.app_context():
+            return pay.db.session.query(pay.Meal.id, pay.Meal.name, pay.Meal.price).order_by(pay.Meal.id).all()
+
+    def test_upsert(self):
+        self.assertEqual(self.post([{'name': '紅茶', 'price': 20}, {'name': '太陽蛋', 'price': 15}])[0], 200)
+        status, body = self.post([{'id': 1, 'name': '奶茶', 'price': 25}, {'name': '太陽蛋', 'price': 18}])
+        self.assertEqual((status, body['inserted'], body['updated']), (200, 0, 2))
+        self.assertEqual(self.meals(), [(1, '奶茶', 25), (2, '太陽蛋', 18)])
+
+    def test_same_meal_by_id_and_name(self):
+        self.post([{'name': '紅茶', 'price': 20}])
+        status, body = self.post([{'id': 1, 'name': '奶茶', 'price': 25}, {'name': '紅茶', 'price': 30}])
+        self.assertEqual(status, 400)
+        self.assertEqual(body['errors'], [{'row': 2, 'msg': '餐點重複'}])
+        self.assertEqual(self.meals(), [(1, '紅茶', 20)])
+
+    def test_invalid_array(self):
+        response = self.client.post('/meals/bulk', data=b'[{"name": "a", "price": 1} {"name": "b", "price": 2}]',
+                                    content_type='application/json', headers=XHR)
+        self.assertEqual(response.status_code, 400)
+        response.close()
+        self.assertEqual(self.meals(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError
+from contextlib import nullcontext
+
+class Timeout(Exception):
+    ''' a job waited longer than the writer timeout. started is False when it was dropped from the queue
+        and never runs, True when it was already running and may still commit '''
+    def __init__(self, message, started):
+        super(Timeout, self).__init__(message)
+        self.started = started
+
+class Writer(threading.Thread):
+    ''' The only thread writing to the database. Request threads submit job(session) functions,
+        whatever is queued runs in one transaction and one commit. If a job fails, the batch is
+        rolled back and its jobs are run again one transaction each, so only that job fails.
+        context() is entered around the thread's work, inside the app context.
+        submit() waits timeout seconds at most, so a stalled writer cannot hold every request thread.'''
+
+    def __init__(self, app, db, batch=32, context=None, timeout=10):
+        super(Writer, self).__init__()
+        self.daemon = True
+        self._app = app
+        self._db = db
+        self._batch = batch
+        self._context = context
+        self._timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        ''' run job(session) on the writer thread, wait and return its result or raise its exception,
+            or Timeout when the writer has not finished it in time, see Timeout.started '''
+        with self._lock: # started on first use, so each forked process runs its own
+            if not self.is_alive():
+                self.start()
+        future = Future()
+        self._queue.put((job, future))
+        try:
+            return future.result(self._timeout)
+        except TimeoutError:
+            if future.cancel(): # still queued, it is not run
+                raise Timeout('the writer did not start the job in %s seconds' % self._timeout, False)
+            if future.done():
+                return future.result()
+            raise Timeout('the writer did not finish the job in %s seconds' % self._timeout, True)
+
+    def stop(self):
+        ''' end the thread once the jobs queued before are done '''
+        with self._lock:
+            if self.is_alive():
+                self._queue.put(None)
+
+    def run(self):
+        with self._app.app_context(), (self._context or nullcontext)():
+            session = self._db.create_scoped_session()
+            running = True
+            while running:
+                jobs = [self._queue.get()]
+                while len(jobs) < self._batch and jobs[-1] is not None:
+                    try:
+                        jobs.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if jobs[-1] is None:
+                    running = False
+                    jobs.pop()
+                jobs = [(job, future) for job, future in jobs if future.set_running_or_notify_cancel()]
+                if jobs and not self._transaction(session, jobs) and len(jobs) > 1:
+                    for job in jobs:
+                        self._transaction(session, [job])
+                session.remove()
+
+    def _transaction(self, session, jobs):
+        results = []
+        try:
+            for job, future in jobs:
+                results.append(job(session))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            if len(jobs) == 1:
+                jobs[0][1].set_exception(e)
+            return False
+        for (job, future), result in zip(jobs, results):
+            future.set_result(result)
+        return True
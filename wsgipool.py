@@ -0,0 +1,105 @@
+import sys
+from io import BytesIO
+from tornado import escape, gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler
+
+def environ(request):
+    ''' WSGI environ for a tornado HTTPServerRequest, as tornado.wsgi.WSGIContainer builds it '''
+    hostport = request.host.split(":")
+    if len(hostport) == 2:
+        host = hostport[0]
+        port = int(hostport[1])
+    else:
+        host = request.host
+        port = 443 if request.protocol == "https" else 80
+    env = {
+        "REQUEST_METHOD": request.method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": escape.url_unescape(request.path, encoding=None, plus=False).decode("latin1"),
+        "QUERY_STRING": request.query,
+        "REMOTE_ADDR": request.remote_ip,
+        "SERVER_NAME": host,
+        "SERVER_PORT": str(port),
+        "SERVER_PROTOCOL": request.version,
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": request.protocol,
+        "wsgi.input": BytesIO(escape.utf8(request.body)),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if "Content-Type" in request.headers:
+        env["CONTENT_TYPE"] = request.headers.pop("Content-Type")
+    if "Content-Length" in request.headers:
+        env["CONTENT_LENGTH"] = request.headers.pop("Content-Length")
+    for key, value in request.headers.items():
+        env["HTTP_" + key.replace("-", "_").upper()] = value
+    return env
+
+class WSGIHandler(RequestHandler):
+    ''' Run a WSGI app on a thread pool so a slow request does not block the IOLoop.
+        The response is streamed back chunk by chunk through IOLoop callbacks.
+        With an admission.Admission, a request only goes to the pool once it has a slot.'''
+    SUPPORTED_METHODS = ("GET", "HEAD", "POST", "DELETE", "PATCH", "PUT", "OPTIONS")
+
+    def initialize(self, wsgi_app, executor, admission=None):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+        self.admission = admission
+        self._loop = IOLoop.current()
+
+    @gen.coroutine
+    def prepare(self):
+        if self.admission:
+            route = self.admission.routeClass(self.request.method, self.request.path)
+            admitted = yield self.admission.admit(route)
+            if not admitted:
+                self.admission.reject(self)
+                return
+        try:
+            yield self.executor.submit(self._call, environ(self.request))
+        finally:
+            if self.admission:
+                self.admission.release(route)
+        # the pool future can be done before the IOLoop ran the callbacks _call queued, finish after them
+        flushed = Future()
+        self._loop.add_callback(flushed.set_result, None)
+        yield flushed
+        self.finish()
+
+    # runs on a pool thread
+    def _call(self, env):
+        started = []
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [(status, headers)]
+            return write
+        def write(chunk):
+            if started:
+                self._loop.add_callback(self._start, *started.pop())
+            if chunk:
+                self._loop.add_callback(self._write, chunk)
+        result = self.wsgi_app(env, start_response)
+        try:
+            for chunk in result:
+                write(chunk)
+            write(b"")
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    # IOLoop side
+    def _start(self, status, headers):
+        code, reason = status.split(" ", 1)
+        self.set_status(int(code), reason)
+        self.clear_header("Content-Type")
+        for name, value in headers:
+            self.add_header(name, value)
+
+    def _write(self, chunk):
+        self.write(chunk)
+        self.flush()